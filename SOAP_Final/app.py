@@ -1,17 +1,46 @@
+import contextvars
+import csv
+import hashlib
+import io
+import json
 import logging
-from datetime import datetime
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
 import os
-from urllib.parse import urlsplit, urlunsplit
+import queue
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from urllib.parse import parse_qs, urlsplit, urlunsplit
 from sqlalchemy import text
 
 # Para el servicio SOAP
-from spyne import Application, rpc, ServiceBase, Integer, Unicode, Boolean, ComplexModel, Fault
+from spyne import Application, rpc, ServiceBase, Integer, Unicode, Boolean, ComplexModel, Fault, Array
+from spyne.protocol.json import JsonDocument
 from spyne.protocol.soap import Soap11
 from spyne.server.wsgi import WsgiApplication
 
+# Para el servidor HTTP
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import make_server, WSGIServer
+from wsgiref.util import request_uri
+
 # Para la Base de Datos (ORM)
-from sqlalchemy import create_engine, Column, Integer as SqlInteger, String, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Integer as SqlInteger, String, DateTime, ForeignKey, Text
+from sqlalchemy import insert, select, update, delete, literal, literal_column, union_all, func, tuple_, Select
+from sqlalchemy import Index, PrimaryKeyConstraint, table, column, inspect
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import Session
 
 logging.basicConfig(level=logging.INFO)
@@ -31,11 +60,86 @@ else:
     if DATABASE_URL.startswith('mysql://'):
         DATABASE_URL = DATABASE_URL.replace('mysql://', 'mysql+pymysql://', 1)
 
-# Para SQLite algunos adaptadores requieren connect_args
-if DATABASE_URL.startswith('sqlite'):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(DATABASE_URL)
+# Ajustes del pool de conexiones (se ignoran tamaño/overflow/timeout en SQLite):
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (segundos),
+#   DB_POOL_RECYCLE (segundos, -1 = nunca), DB_POOL_PRE_PING (1/0)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1').lower() in ('1', 'true', 'si', 'yes')
+
+
+# Perfil de SQLite: 'basico' (por defecto) o 'rendimiento'. El perfil de
+# rendimiento activa WAL y pragmas en cada conexión y envía las escrituras a
+# un único hilo escritor que agrupa los commits (ver EscritorAgrupado).
+SQLITE_PERFIL = os.getenv('SQLITE_PERFIL', 'basico').lower()
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHE_KB = int(os.getenv('SQLITE_CACHE_KB', '65536'))
+SQLITE_MMAP_BYTES = int(os.getenv('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+
+def _configurar_sqlite_rendimiento(engine):
+    @event.listens_for(engine, 'connect')
+    def _pragmas(dbapi_connection, connection_record):
+        # Desactivar el BEGIN implícito de pysqlite: SQLAlchemy emite BEGIN
+        # explícito (abajo), necesario para que los SAVEPOINT funcionen bien.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_KB}')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_BYTES}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def _begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+
+def _activar_claves_foraneas_sqlite(engine):
+    # SQLite no comprueba las claves foráneas salvo que se pida en cada
+    # conexión; las escrituras dependen de ellas en lugar de validar con SELECT.
+    @event.listens_for(engine, 'connect')
+    def _claves_foraneas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def _crear_engine(url: str):
+    opciones = {'pool_pre_ping': DB_POOL_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE}
+    # Para SQLite algunos adaptadores requieren connect_args
+    if url.startswith('sqlite'):
+        opciones['connect_args'] = {"check_same_thread": False}
+    else:
+        opciones.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    nuevo = create_engine(url, **opciones)
+    if url.startswith('sqlite'):
+        _activar_claves_foraneas_sqlite(nuevo)
+        if SQLITE_PERFIL == 'rendimiento':
+            _configurar_sqlite_rendimiento(nuevo)
+    return nuevo
+
+
+# El engine principal se crea en el primer uso (obtener_engine), no al
+# importar el módulo: importar no carga el driver ni abre conexiones.
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def obtener_engine():
+    """Devuelve el engine principal, creándolo (y enlazando SessionLocal) la primera vez."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _crear_engine(DATABASE_URL)
+                SessionLocal.configure(bind=_engine)
+    return _engine
 
 
 def _mask_db_url(url: str) -> str:
@@ -72,7 +176,39 @@ def _check_db_connection(engine, url):
     except Exception as e:
         logging.exception(f"No se pudo conectar a la base de datos remota: {masked}")
         return False
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+class _FabricaSesiones(sessionmaker):
+    """sessionmaker que crea el engine principal al abrir la primera sesión."""
+
+    def __call__(self, **kw):
+        obtener_engine()
+        return super().__call__(**kw)
+
+
+SessionLocal = _FabricaSesiones(autocommit=False, autoflush=False)
+
+
+def reiniciar_engine():
+    """Crea un engine nuevo y vuelve a enlazar SessionLocal.
+
+    Se usa en cada proceso trabajador tras el fork: las conexiones del pool no
+    pueden compartirse entre procesos.
+    """
+    global _engine
+    with _engine_lock:
+        _engine = _crear_engine(DATABASE_URL)
+        SessionLocal.configure(bind=_engine)
+    enrutador_lecturas.reiniciar()
+    return _engine
+
+
+def _liberar_engine():
+    """Cierra las conexiones del pool principal, si llegó a crearse."""
+    if _engine is not None:
+        _engine.dispose()
+
+
 Base = declarative_base()
 
 
@@ -90,6 +226,285 @@ def safe_commit(db: Session):
         raise Fault(faultcode='Server', faultstring=f'Error en la base de datos: {str(e)}')
 
 
+def _aplicar_escritura(db: Session, aplicar, construir=None):
+    """Ejecuta `aplicar(db)`, envía los cambios con flush y arma la respuesta con
+    `construir(valor)` antes del commit.
+
+    Construir tras el flush evita la relectura (refresh) que provocaría el commit
+    al expirar los objetos: con RETURNING los ids y los valores por defecto del
+    servidor ya vienen en el propio INSERT/UPDATE.
+    """
+    valor = aplicar(db)
+    db.flush()
+    return construir(valor) if construir else valor
+
+
+def _error_de_integridad(db: Session, error, diagnosticar=None):
+    """Convierte un IntegrityError (ya revertido) en la excepción para el cliente.
+
+    Las escrituras no validan antes con SELECT: dejan que la BD rechace la fila
+    por clave foránea y solo entonces `diagnosticar(db)` busca qué referencia
+    falta para devolver el mismo mensaje que la validación previa
+    (p. ej. "Encuesta no encontrada con id: X").
+    """
+    mensaje = None
+    if diagnosticar is not None:
+        try:
+            mensaje = diagnosticar(db)
+        except Exception:
+            logging.exception('Error diagnosticando un fallo de integridad')
+    if mensaje:
+        return ValueError(mensaje)
+    logging.warning('Escritura rechazada por la base de datos: %s', error)
+    return Fault(faultcode='Server', faultstring=f'Error en la base de datos: {str(error)}')
+
+# Réplicas de lectura: DATABASE_REPLICA_URLS es una lista separada por comas.
+# Las lecturas se reparten en round-robin entre las réplicas sanas y, si no
+# hay ninguna, van a la principal. Un cliente que acaba de escribir lee de la
+# principal durante DB_LECTURA_PROPIA_SEGUNDOS (read-your-writes). El cliente
+# se identifica por la cabecera X-Cliente-Id o, si no existe, por su IP.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+DB_LECTURA_PROPIA_SEGUNDOS = float(os.getenv('DB_LECTURA_PROPIA_SEGUNDOS', '5'))
+DB_REPLICA_VERIFICACION_SEGUNDOS = float(os.getenv('DB_REPLICA_VERIFICACION_SEGUNDOS', '10'))
+
+
+class EnrutadorLecturas:
+    """Reparte las sesiones de solo lectura entre réplicas con verificación de salud.
+
+    Los engines de las réplicas se crean en la primera lectura que los necesita
+    (como `obtener_engine()`), no al construir el enrutador.
+    """
+
+    def __init__(self, urls):
+        self.urls = [url.replace('mysql://', 'mysql+pymysql://', 1) if url.startswith('mysql://') else url
+                     for url in urls]
+        self._lock = threading.Lock()
+        self._lock_replicas = threading.Lock()
+        self._escrituras = {}
+        self._siguiente = 0
+        self._hilo = None
+        self._pid = None
+        self._replicas = None
+
+    @property
+    def replicas(self):
+        """Réplicas con su engine y estado de salud; se crean en el primer acceso."""
+        if self._replicas is None:
+            with self._lock_replicas:
+                if self._replicas is None:
+                    replicas = []
+                    for url in self.urls:
+                        motor = _crear_engine(url)
+                        replicas.append({'url': url, 'engine': motor, 'sana': True,
+                                         'sesiones': sessionmaker(autocommit=False, autoflush=False, bind=motor,
+                                                                  info={'replica': True})})
+                    self._replicas = replicas
+        return self._replicas
+
+    def reiniciar(self):
+        """Descarta los engines de las réplicas (se vuelven a crear en el
+        siguiente uso); se llama también tras el fork."""
+        with self._lock_replicas:
+            for replica in self._replicas or []:
+                # close=False: no cerrar conexiones que pueda seguir usando el proceso padre
+                replica['engine'].dispose(close=False)
+            self._replicas = None
+        self._hilo = None
+
+    def _asegurar_verificacion(self):
+        if not self.urls or (self._hilo is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._hilo is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._verificar_periodicamente, name='verificar-replicas',
+                                              daemon=True)
+                self._hilo.start()
+
+    def verificar(self):
+        for replica in self.replicas:
+            try:
+                with replica['engine'].connect() as conn:
+                    conn.execute(text('SELECT 1'))
+                sana = True
+            except Exception:
+                sana = False
+            if sana != replica['sana']:
+                nivel = logging.INFO if sana else logging.WARNING
+                logging.log(nivel, f"Réplica {_mask_db_url(replica['url'])} {'disponible' if sana else 'no disponible'}")
+            replica['sana'] = sana
+
+    def _verificar_periodicamente(self):
+        while True:
+            self.verificar()
+            time.sleep(DB_REPLICA_VERIFICACION_SEGUNDOS)
+
+    def registrar_escritura(self, clave_cliente):
+        if not self.urls or clave_cliente is None:
+            return
+        ahora = time.monotonic()
+        with self._lock:
+            self._escrituras[clave_cliente] = ahora
+            if len(self._escrituras) > 10000:
+                limite = ahora - DB_LECTURA_PROPIA_SEGUNDOS
+                self._escrituras = {k: v for k, v in self._escrituras.items() if v >= limite}
+
+    def en_lectura_propia(self, clave_cliente):
+        """True si el cliente escribió hace menos de DB_LECTURA_PROPIA_SEGUNDOS:
+        sus lecturas deben ir a la principal."""
+        if not self.urls or clave_cliente is None:
+            return False
+        with self._lock:
+            ultima = self._escrituras.get(clave_cliente)
+        return ultima is not None and time.monotonic() - ultima < DB_LECTURA_PROPIA_SEGUNDOS
+
+    def _replica_para(self, clave_cliente):
+        """Devuelve la réplica a usar o None si hay que leer de la principal."""
+        if not self.urls or self.en_lectura_propia(clave_cliente):
+            return None
+        replicas = self.replicas
+        self._asegurar_verificacion()
+        with self._lock:
+            for _ in range(len(replicas)):
+                replica = replicas[self._siguiente % len(replicas)]
+                self._siguiente += 1
+                if replica['sana']:
+                    return replica
+        return None
+
+    def sesion_lectura(self, clave_cliente=None):
+        replica = self._replica_para(clave_cliente)
+        return SessionLocal() if replica is None else replica['sesiones']()
+
+    def engine_lectura(self, clave_cliente=None):
+        replica = self._replica_para(clave_cliente)
+        return obtener_engine() if replica is None else replica['engine']
+
+
+def _clave_cliente(ctx):
+    """Identifica al cliente de una petición SOAP para read-your-writes."""
+    transporte = getattr(ctx, 'transport', None) if ctx is not None else None
+    env = getattr(transporte, 'req_env', None) or {}
+    return env.get('HTTP_X_CLIENTE_ID') or env.get('REMOTE_ADDR')
+
+
+enrutador_lecturas = EnrutadorLecturas(DATABASE_REPLICA_URLS)
+
+
+class EscritorAgrupado:
+    """Hilo escritor único que agrupa en un solo commit las escrituras que
+    llegan juntas (group commit).
+
+    Cada trabajo se aplica dentro de un SAVEPOINT, de modo que el error de un
+    llamador (p.ej. un ValueError de validación) no afecta a los demás: cada
+    uno recibe su propio resultado o excepción.
+      ESCRITOR_LOTE_MAX:   máximo de trabajos por commit.
+      ESCRITOR_ESPERA_MS:  tiempo máximo que se espera a más trabajos antes de
+                           hacer commit (0 = agrupar solo lo que ya está en cola).
+    """
+
+    def __init__(self, lote_max=None, espera_ms=None):
+        self.lote_max = lote_max or int(os.getenv('ESCRITOR_LOTE_MAX', '256'))
+        espera_ms = float(os.getenv('ESCRITOR_ESPERA_MS', '2')) if espera_ms is None else espera_ms
+        self.espera = espera_ms / 1000.0
+        self._cola = queue.Queue()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self._pid = None
+
+    def _asegurar_hilo(self):
+        # Tras un fork el hilo del padre no existe en el hijo: crear uno por proceso
+        if self._hilo is not None and self._pid == os.getpid() and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._hilo is None or self._pid != os.getpid() or not self._hilo.is_alive():
+                self._cola = queue.Queue()
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name='escritor-agrupado', daemon=True)
+                self._hilo.start()
+
+    def ejecutar(self, aplicar, construir=None, diagnosticar=None):
+        self._asegurar_hilo()
+        trabajo = {'aplicar': aplicar, 'construir': construir, 'diagnosticar': diagnosticar,
+                   'listo': threading.Event(), 'resultado': None, 'error': None}
+        self._cola.put(trabajo)
+        trabajo['listo'].wait()
+        if trabajo['error'] is not None:
+            raise trabajo['error']
+        return trabajo['resultado']
+
+    def _bucle(self):
+        cola = self._cola
+        while True:
+            lote = [cola.get()]
+            limite = time.monotonic() + self.espera
+            while len(lote) < self.lote_max:
+                restante = limite - time.monotonic()
+                try:
+                    lote.append(cola.get(timeout=restante) if restante > 0 else cola.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._procesar(lote)
+            except Exception as e:
+                logging.exception('Error inesperado en el escritor agrupado')
+                for trabajo in lote:
+                    if not trabajo['listo'].is_set():
+                        trabajo['error'] = e
+                        trabajo['listo'].set()
+
+    def _procesar(self, lote):
+        db = SessionLocal()
+        try:
+            aplicados = []
+            for trabajo in lote:
+                savepoint = db.begin_nested()
+                try:
+                    trabajo['resultado'] = _aplicar_escritura(db, trabajo['aplicar'], trabajo['construir'])
+                    savepoint.commit()
+                    aplicados.append(trabajo)
+                except IntegrityError as e:
+                    savepoint.rollback()
+                    trabajo['error'] = _error_de_integridad(db, e, trabajo['diagnosticar'])
+                    trabajo['listo'].set()
+                except Exception as e:
+                    savepoint.rollback()
+                    trabajo['error'] = e
+                    trabajo['listo'].set()
+            try:
+                safe_commit(db)
+            except Fault as fault:
+                for trabajo in aplicados:
+                    trabajo['error'] = fault
+                    trabajo['resultado'] = None
+            for trabajo in aplicados:
+                trabajo['listo'].set()
+        finally:
+            db.close()
+
+
+escritor_agrupado = EscritorAgrupado() if DATABASE_URL.startswith('sqlite') and SQLITE_PERFIL == 'rendimiento' else None
+
+
+# Número máximo de respuestas aceptadas en una sola llamada a crear_respuestas_lote
+LOTE_MAX_RESPUESTAS = int(os.getenv('LOTE_MAX_RESPUESTAS', '1000'))
+
+# Días que `depurar-cambios` conserva en el registro de cambios por defecto
+CAMBIOS_RETENCION_DIAS = int(os.getenv('CAMBIOS_RETENCION_DIAS', '30'))
+
+# `id_cambio` se asigna al hacer el INSERT, pero la fila se ve al hacer COMMIT:
+# con escritores concurrentes (MySQL, PostgreSQL) un cambio con id menor puede
+# confirmarse después que uno con id mayor. obtener_cambios_desde no entrega
+# cambios con menos de CAMBIOS_MARGEN_SEGUNDOS de antigüedad, que debe superar
+# la transacción de escritura más larga. En SQLite los escritores van de uno
+# en uno (los ids siguen el orden de commit) y por defecto no hay margen.
+CAMBIOS_MARGEN_SEGUNDOS = float(os.getenv('CAMBIOS_MARGEN_SEGUNDOS', '0' if DATABASE_URL.startswith('sqlite') else '5'))
+
+# Tamaño de página por defecto y máximo para las operaciones listar_*
+LISTADO_LIMITE_DEFECTO = int(os.getenv('LISTADO_LIMITE_DEFECTO', '100'))
+LISTADO_LIMITE_MAX = int(os.getenv('LISTADO_LIMITE_MAX', '1000'))
+
+
 # --- 2. Modelos de la Base de Datos (SQLAlchemy) ---
 
 
@@ -100,11 +515,16 @@ class EncuestaDB(Base):
     titulo = Column(String(255), nullable=True)
     descripcion = Column(String(255), nullable=True)
     estatus = Column(SqlInteger, nullable=True)
-    fecha_creacion = Column(DateTime, nullable=True)
+    # Las fechas las pone la BD; en el INSERT se devuelven con RETURNING
+    fecha_creacion = Column(DateTime, nullable=True, server_default=func.current_timestamp())
 
 
 class PreguntaDB(Base):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # preguntas de una encuesta en orden de id (listados, cascada, resultados)
+        Index('ix_questions_encuesta_pregunta', 'id_encuesta', 'id_pregunta'),
+    )
 
     id_pregunta = Column(SqlInteger, primary_key=True, autoincrement=True)
     # la columna en la BD existente se llama `id_encuesta`
@@ -115,25 +535,489 @@ class PreguntaDB(Base):
 
 class RespuestaDB(Base):
     __tablename__ = 'answers'
+    __table_args__ = (
+        # recorridos por pregunta/usuario paginados por id_respuesta (keyset)
+        Index('ix_answers_pregunta_respuesta', 'id_pregunta', 'id_respuesta'),
+        Index('ix_answers_usuario_respuesta', 'id_usuario', 'id_respuesta'),
+        # exportación por rango de fechas
+        Index('ix_answers_fecha_registrada', 'fecha_registrada'),
+    )
 
     id_respuesta = Column(SqlInteger, primary_key=True, autoincrement=True)
     id_pregunta = Column(SqlInteger, ForeignKey('questions.id_pregunta'), nullable=False)
     id_usuario = Column(SqlInteger, ForeignKey('users.id_usuario'), nullable=True)
     texto_respuesta = Column(String(255), nullable=True)
-    fecha_registro = Column('fecha_registrada', DateTime, nullable=True)
+    fecha_registro = Column('fecha_registrada', DateTime, nullable=True, server_default=func.current_timestamp())
 
 
 class UsuarioDB(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_email', 'email'),
+    )
 
     id_usuario = Column(SqlInteger, primary_key=True, autoincrement=True)
     nombre = Column(String(255), nullable=True)
     apellidos = Column(String(255), nullable=True)
     email = Column(String(255), nullable=True)
-    fecha_creacion = Column(DateTime, nullable=True)
+    fecha_creacion = Column(DateTime, nullable=True, server_default=func.current_timestamp())
     genero = Column(String(255), nullable=True)
     telefono = Column(String(255), nullable=True)
 
+class ConteoRespuestaDB(Base):
+    """Conteo agregado de respuestas por pregunta y texto de respuesta.
+
+    Se mantiene de forma incremental en la misma transacción que
+    crear/actualizar/eliminar respuestas; `reconstruir_resultados` lo
+    recalcula a partir de `answers`.
+    """
+    __tablename__ = 'answer_counts'
+
+    id_pregunta = Column(SqlInteger, primary_key=True, autoincrement=False)
+    # Las respuestas sin texto se agregan bajo la cadena vacía
+    texto_respuesta = Column(String(255), primary_key=True)
+    total = Column(SqlInteger, nullable=False, default=0)
+
+
+class TokenBusquedaDB(Base):
+    """Índice invertido portable para la búsqueda de texto: una fila por
+    (entidad, palabra, id) con el número de apariciones (ver IndiceTokens)."""
+    __tablename__ = 'search_tokens'
+    __table_args__ = (
+        PrimaryKeyConstraint('entidad', 'token', 'id_entidad'),
+        # para borrar los tokens de una entidad al actualizarla o eliminarla
+        Index('ix_search_tokens_entidad_id', 'entidad', 'id_entidad'),
+    )
+
+    entidad = Column(String(20), nullable=False)
+    token = Column(String(64), nullable=False)
+    id_entidad = Column(SqlInteger, nullable=False)
+    frecuencia = Column(SqlInteger, nullable=False, default=1)
+
+
+class CambioDB(Base):
+    """Registro de cambios (solo se añaden filas) para la sincronización incremental.
+
+    Cada alta, modificación o baja de una entidad inserta una fila en la misma
+    transacción que el cambio; `id_cambio` es el cursor de `obtener_cambios_desde`.
+    """
+    __tablename__ = 'change_log'
+
+    id_cambio = Column(SqlInteger, primary_key=True, autoincrement=True)
+    # 'encuesta', 'pregunta', 'usuario' o 'respuesta'
+    entidad = Column(String(20), nullable=False)
+    id_entidad = Column(SqlInteger, nullable=False)
+    # 'crear', 'actualizar' o 'eliminar'
+    operacion = Column(String(10), nullable=False)
+    fecha = Column(DateTime, nullable=True, server_default=func.current_timestamp())
+
+
+class TareaPurgaDB(Base):
+    """Estado de una purga de encuesta en segundo plano. Vive en la BD para que
+    cualquier proceso trabajador pueda informar del progreso; el hilo de la
+    purga actualiza la fila en la misma transacción que cada lote."""
+    __tablename__ = 'purge_tasks'
+
+    id_tarea = Column(String(32), primary_key=True)
+    id_encuesta = Column(SqlInteger, nullable=False)
+    # 'pendiente', 'en_curso', 'completada' o 'error'
+    estado = Column(String(20), nullable=False, default='pendiente')
+    respuestas_eliminadas = Column(SqlInteger, nullable=False, default=0)
+    preguntas_eliminadas = Column(SqlInteger, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    fecha_inicio = Column(DateTime, nullable=True, server_default=func.current_timestamp())
+    fecha_fin = Column(DateTime, nullable=True)
+
+
+class RespuestaDiferidaDB(Base):
+    """Respuestas del spool de escritura diferida ya insertadas en `answers`.
+
+    Se escribe en la misma transacción que la respuesta: si el proceso cae antes
+    de marcarla en el spool, al reintentarla se reconoce como ya guardada en vez
+    de insertarla dos veces (ver SpoolRespuestas). Sin clave foránea, para no
+    impedir borrar la respuesta.
+    """
+    __tablename__ = 'spooled_answers'
+
+    # identificador del archivo de spool (varios servidores pueden tener el suyo)
+    origen = Column(String(32), primary_key=True)
+    id_provisional = Column(SqlInteger, primary_key=True)
+    id_respuesta = Column(SqlInteger, nullable=False)
+
+
+
+def _ids_existentes(db: Session, ids_preguntas, ids_usuarios):
+    """Comprueba en una sola consulta qué preguntas y usuarios existen.
+
+    Devuelve dos conjuntos: (ids de preguntas existentes, ids de usuarios existentes).
+    """
+    consultas = []
+    if ids_preguntas:
+        consultas.append(select(literal('p').label('tipo'), PreguntaDB.id_pregunta.label('id'))
+                         .where(PreguntaDB.id_pregunta.in_(ids_preguntas)))
+    if ids_usuarios:
+        consultas.append(select(literal('u').label('tipo'), UsuarioDB.id_usuario.label('id'))
+                         .where(UsuarioDB.id_usuario.in_(ids_usuarios)))
+    preguntas, usuarios = set(), set()
+    if not consultas:
+        return preguntas, usuarios
+    stmt = consultas[0] if len(consultas) == 1 else union_all(*consultas)
+    for tipo, id_ in db.execute(stmt):
+        (preguntas if tipo == 'p' else usuarios).add(id_)
+    return preguntas, usuarios
+
+
+def _actualizar_devolviendo(db: Session, modelo, columna_id, id_, valores: dict):
+    """Actualiza una fila por id y devuelve su estado final, o None si no existe.
+
+    Con UPDATE ... RETURNING es una sola sentencia; en dialectos sin RETURNING
+    (MySQL) se carga la fila, se modifica y se envía con flush. El resultado
+    tiene los mismos atributos que el modelo ORM (sirve para los `_a_*`).
+    """
+    if getattr(db.get_bind().dialect, 'update_returning', False):
+        columnas = [getattr(modelo, atributo.key) for atributo in modelo.__mapper__.column_attrs]
+        stmt = update(modelo).where(columna_id == id_).values(**valores).returning(*columnas)
+        return db.execute(stmt, execution_options={'synchronize_session': False}).first()
+    obj = db.query(modelo).filter(columna_id == id_).first()
+    if obj is None:
+        return None
+    for atributo, valor in valores.items():
+        setattr(obj, atributo, valor)
+    db.flush()
+    return obj
+
+
+def _verificar_referencias(*referencias):
+    """Construye el `diagnosticar` de una escritura a partir de tuplas
+    (columna id, valor, mensaje): devuelve el mensaje de la primera referencia
+    que no existe. Solo se ejecuta cuando la BD ya rechazó la escritura."""
+    def diagnosticar(db: Session):
+        for columna_id, valor, mensaje in referencias:
+            if valor and db.query(columna_id).filter(columna_id == valor).first() is None:
+                return mensaje
+        return None
+    return diagnosticar
+
+
+def _registrar_cambios(db: Session, entidad, operacion, ids):
+    """Anota en `change_log` un cambio por id y actualiza el índice de
+    búsqueda (no hace commit).
+
+    `ids` es una lista de ids o un SELECT de una sola columna; con un SELECT el
+    registro se hace con un INSERT ... SELECT, sin traer los ids a Python (para
+    las bajas en cascada, antes del DELETE).
+    """
+    indice_busqueda.sincronizar(db, entidad, operacion, ids)
+    tabla = CambioDB.__table__
+    if isinstance(ids, Select):
+        origen = ids.subquery()
+        db.execute(insert(tabla).from_select(
+            ['entidad', 'id_entidad', 'operacion'],
+            select(literal(entidad), origen.c[0], literal(operacion)).select_from(origen)))
+    elif ids:
+        db.execute(insert(tabla), [{'entidad': entidad, 'id_entidad': id_, 'operacion': operacion} for id_ in ids])
+
+
+def _cambios_asentados(db: Session, cambios):
+    """Corta una página de cambios (en orden de id) antes del primero con
+    menos de CAMBIOS_MARGEN_SEGUNDOS según el reloj de la BD: el cursor del
+    cliente no debe adelantar a un cambio con id menor aún sin confirmar."""
+    if not CAMBIOS_MARGEN_SEGUNDOS or not cambios:
+        return cambios
+    hasta = db.scalar(select(func.current_timestamp())) - timedelta(seconds=CAMBIOS_MARGEN_SEGUNDOS)
+    for posicion, cambio in enumerate(cambios):
+        if cambio.fecha is not None and cambio.fecha > hasta:
+            return cambios[:posicion]
+    return cambios
+
+
+def depurar_cambios(db: Session, dias):
+    """Borra del registro de cambios las filas con más de `dias` días (según el
+    reloj de la BD, que es el que pone `fecha`). Los clientes con un cursor más
+    antiguo deben volver a descargar todo."""
+    antes_de = db.scalar(select(func.current_timestamp())) - timedelta(days=dias)
+    borrados = db.execute(delete(CambioDB).where(CambioDB.fecha < antes_de),
+                          execution_options={'synchronize_session': False}).rowcount
+    safe_commit(db)
+    return borrados
+
+
+def _insertar_respuestas(db: Session, filas):
+    """Inserta varias respuestas con un INSERT multi-fila y devuelve los ids
+    generados en el mismo orden que `filas` (no hace commit)."""
+    dialecto = db.get_bind().dialect
+    if getattr(dialecto, 'insert_executemany_returning_sort_by_parameter_order', False):
+        stmt = insert(RespuestaDB).returning(RespuestaDB.id_respuesta, sort_by_parameter_order=True)
+        return list(db.scalars(stmt, filas))
+    if dialecto.name in ('mysql', 'mariadb', 'sqlite'):
+        # Sin RETURNING: un solo INSERT ... VALUES (...), (...). Las filas de una
+        # inserción simple reciben ids consecutivos (InnoDB los reserva de una vez
+        # en cualquier innodb_autoinc_lock_mode; SQLite tiene un único escritor),
+        # así que se deducen de lastrowid.
+        resultado = db.execute(insert(RespuestaDB).values(filas))
+        if dialecto.name == 'sqlite':
+            # lastrowid es el id de la última fila
+            return list(range(resultado.lastrowid - len(filas) + 1, resultado.lastrowid + 1))
+        # MySQL: lastrowid es el id de la primera fila
+        paso = _incremento_autoincremental(db)
+        return [resultado.lastrowid + posicion * paso for posicion in range(len(filas))]
+    # Otros dialectos sin RETURNING: el ORM envía un INSERT por fila en el mismo flush
+    objetos = [RespuestaDB(**fila) for fila in filas]
+    db.add_all(objetos)
+    db.flush()
+    return [obj.id_respuesta for obj in objetos]
+
+
+def _incremento_autoincremental(db: Session):
+    """@@auto_increment_increment de la conexión (MySQL), guardado en su `info`."""
+    info = db.connection().info
+    if 'auto_increment_increment' not in info:
+        info['auto_increment_increment'] = db.scalar(text('SELECT @@auto_increment_increment'))
+    return info['auto_increment_increment']
+
+def _upsert_conteos():
+    """Devuelve una sentencia INSERT ... ON CONFLICT/DUPLICATE KEY que suma
+    `total` al conteo existente, o None si el dialecto no la soporta."""
+    tabla = ConteoRespuestaDB.__table__
+    nombre = obtener_engine().dialect.name
+    if nombre in ('sqlite', 'postgresql'):
+        stmt = (sqlite_insert if nombre == 'sqlite' else postgresql_insert)(tabla)
+        return stmt.on_conflict_do_update(index_elements=[tabla.c.id_pregunta, tabla.c.texto_respuesta],
+                                          set_={'total': tabla.c.total + stmt.excluded.total})
+    if nombre in ('mysql', 'mariadb'):
+        stmt = mysql_insert(tabla)
+        return stmt.on_duplicate_key_update(total=tabla.c.total + stmt.inserted.total)
+    return None
+
+
+def _ajustar_conteos(db: Session, deltas):
+    """Aplica incrementos/decrementos a `answer_counts` (no hace commit).
+
+    `deltas` es un dict {(id_pregunta, texto_respuesta): cantidad}.
+    """
+    filas = [{'id_pregunta': id_pregunta, 'texto_respuesta': texto or '', 'total': cantidad}
+             for (id_pregunta, texto), cantidad in deltas.items() if cantidad]
+    if not filas:
+        return
+    tabla = ConteoRespuestaDB.__table__
+    stmt = _upsert_conteos()
+    if stmt is not None:
+        db.execute(stmt, filas)
+    else:
+        for fila in filas:
+            actualizadas = db.execute(
+                update(tabla)
+                .where(tabla.c.id_pregunta == fila['id_pregunta'], tabla.c.texto_respuesta == fila['texto_respuesta'])
+                .values(total=tabla.c.total + fila['total'])).rowcount
+            if not actualizadas:
+                db.execute(insert(tabla), fila)
+    claves = [(fila['id_pregunta'], fila['texto_respuesta']) for fila in filas if fila['total'] < 0]
+    if claves:
+        db.execute(delete(tabla).where(tuple_(tabla.c.id_pregunta, tabla.c.texto_respuesta).in_(claves),
+                                       tabla.c.total <= 0))
+
+
+def reconstruir_resultados(db: Session):
+    """Recalcula por completo `answer_counts` a partir de las respuestas existentes."""
+    tabla = ConteoRespuestaDB.__table__
+    texto = func.coalesce(RespuestaDB.texto_respuesta, '')
+    db.execute(delete(tabla))
+    db.execute(insert(tabla).from_select(
+        ['id_pregunta', 'texto_respuesta', 'total'],
+        select(RespuestaDB.id_pregunta, texto, func.count()).group_by(RespuestaDB.id_pregunta, texto)))
+    safe_commit(db)
+
+
+# Sentencias de la cascada y la purga; `verificar-planes` comprueba los planes
+# de estas mismas construcciones.
+
+def _preguntas_de_encuesta(id_encuesta):
+    """SELECT de los ids de las preguntas de una encuesta."""
+    return select(PreguntaDB.id_pregunta).where(PreguntaDB.id_encuesta == id_encuesta)
+
+
+def _respuestas_de_preguntas(preguntas):
+    """SELECT de los ids de las respuestas de `preguntas` (subconsulta o lista de ids)."""
+    return select(RespuestaDB.id_respuesta).where(RespuestaDB.id_pregunta.in_(preguntas))
+
+
+def _delete_respuestas_de_preguntas(preguntas):
+    return delete(RespuestaDB).where(RespuestaDB.id_pregunta.in_(preguntas))
+
+
+def _lote_purga(preguntas, tamano_lote):
+    """Siguiente lote de respuestas a borrar por la purga, en orden de id."""
+    return _respuestas_de_preguntas(preguntas).order_by(RespuestaDB.id_respuesta).limit(tamano_lote)
+
+
+def _conteos_de_usuario(id_usuario):
+    """Respuestas de un usuario agrupadas por (pregunta, texto), para descontarlas de los conteos."""
+    texto = func.coalesce(RespuestaDB.texto_respuesta, '')
+    return (select(RespuestaDB.id_pregunta, texto, func.count())
+            .where(RespuestaDB.id_usuario == id_usuario)
+            .group_by(RespuestaDB.id_pregunta, texto))
+
+
+# Consultas de lectura de las RPC, construidas aquí para que `verificar-planes`
+# compruebe las mismas sentencias que ejecuta el servicio.
+
+def _paginar(consulta, columna_id, despues_de, limite):
+    """Paginación por cursor (keyset) sobre una clave primaria entera.
+
+    Añade a `consulta` (un SELECT) el filtro y el orden para devolver como
+    máximo `limite` filas con id mayor que `despues_de`, ordenadas por id. El
+    cliente usa el último id recibido como `despues_de` de la siguiente página;
+    una página con menos de `limite` filas indica el final.
+    """
+    if despues_de:
+        consulta = consulta.where(columna_id > despues_de)
+    return consulta.order_by(columna_id).limit(_limite_pagina(limite))
+
+
+def _consulta_preguntas_por_encuesta(id_encuesta, despues_de, limite):
+    return _paginar(select(PreguntaDB).where(PreguntaDB.id_encuesta == id_encuesta),
+                    PreguntaDB.id_pregunta, despues_de, limite)
+
+
+def _consulta_respuestas_por_pregunta(id_pregunta, despues_de, limite):
+    return _paginar(select(RespuestaDB).where(RespuestaDB.id_pregunta == id_pregunta),
+                    RespuestaDB.id_respuesta, despues_de, limite)
+
+
+def _consulta_respuestas_por_encuesta(id_encuesta, despues_de, limite):
+    return _paginar(select(RespuestaDB)
+                    .join(PreguntaDB, PreguntaDB.id_pregunta == RespuestaDB.id_pregunta)
+                    .where(PreguntaDB.id_encuesta == id_encuesta),
+                    RespuestaDB.id_respuesta, despues_de, limite)
+
+
+def _consulta_respuestas_por_usuario(id_usuario, despues_de, limite):
+    return _paginar(select(RespuestaDB).where(RespuestaDB.id_usuario == id_usuario),
+                    RespuestaDB.id_respuesta, despues_de, limite)
+
+
+def _consulta_resultados_encuesta(id_encuesta):
+    """(id_pregunta, texto_pregunta, texto_respuesta, total) de los conteos agregados."""
+    return (select(PreguntaDB.id_pregunta, PreguntaDB.texto_pregunta,
+                   ConteoRespuestaDB.texto_respuesta, ConteoRespuestaDB.total)
+            .join(ConteoRespuestaDB, ConteoRespuestaDB.id_pregunta == PreguntaDB.id_pregunta)
+            .where(PreguntaDB.id_encuesta == id_encuesta)
+            .order_by(PreguntaDB.id_pregunta, ConteoRespuestaDB.total.desc()))
+
+
+def _consulta_cambios_desde(cursor, limite):
+    return _paginar(select(CambioDB), CambioDB.id_cambio, cursor, limite)
+
+
+def _borrar_respuestas_de_preguntas(db: Session, preguntas):
+    """DELETE de las respuestas (y sus conteos) cuyas preguntas cumplen
+    `preguntas`, una subconsulta/lista de ids. Devuelve las filas borradas."""
+    opciones = {'synchronize_session': False}
+    _registrar_cambios(db, 'respuesta', 'eliminar', _respuestas_de_preguntas(preguntas))
+    db.execute(delete(ConteoRespuestaDB).where(ConteoRespuestaDB.id_pregunta.in_(preguntas)), execution_options=opciones)
+    return db.execute(_delete_respuestas_de_preguntas(preguntas), execution_options=opciones).rowcount
+
+
+def borrar_encuesta_en_cascada(db: Session, id_encuesta):
+    """Borra una encuesta con sus preguntas y respuestas mediante unos pocos
+    DELETE por conjuntos (sin cargar objetos). No hace commit.
+
+    Devuelve los ids de las preguntas borradas (para invalidar la caché).
+    """
+    ids_preguntas = list(db.scalars(_preguntas_de_encuesta(id_encuesta)))
+    opciones = {'synchronize_session': False}
+    if ids_preguntas:
+        _borrar_respuestas_de_preguntas(db, _preguntas_de_encuesta(id_encuesta))
+        _registrar_cambios(db, 'pregunta', 'eliminar', ids_preguntas)
+        db.execute(delete(PreguntaDB).where(PreguntaDB.id_encuesta == id_encuesta), execution_options=opciones)
+    if db.execute(delete(EncuestaDB).where(EncuestaDB.id_encuesta == id_encuesta), execution_options=opciones).rowcount:
+        _registrar_cambios(db, 'encuesta', 'eliminar', [id_encuesta])
+    return ids_preguntas
+
+
+def borrar_respuestas_de_usuario(db: Session, id_usuario):
+    """Borra las respuestas de un usuario descontándolas de los conteos. No hace commit."""
+    conteos = db.execute(_conteos_de_usuario(id_usuario))
+    _ajustar_conteos(db, {(id_pregunta, texto): -total for id_pregunta, texto, total in conteos})
+    _registrar_cambios(db, 'respuesta', 'eliminar', select(RespuestaDB.id_respuesta).where(RespuestaDB.id_usuario == id_usuario))
+    return db.execute(delete(RespuestaDB).where(RespuestaDB.id_usuario == id_usuario),
+                      execution_options={'synchronize_session': False}).rowcount
+
+
+def aplicar_indices(bind):
+    """Crea en las tablas existentes los índices declarados en los modelos que
+    aún no tengan (`create_all` no toca tablas que ya existen). Devuelve los
+    nombres de los índices creados."""
+    inspector = inspect(bind)
+    creados = []
+    for tabla in Base.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            continue
+        existentes = {indice['name'] for indice in inspector.get_indexes(tabla.name)}
+        for indice in sorted(tabla.indexes, key=lambda i: i.name):
+            if indice.name not in existentes:
+                indice.create(bind)
+                creados.append(indice.name)
+    return creados
+
+
+def _consultas_criticas():
+    """Consultas frecuentes del servicio, construidas como en las RPC, con
+    valores de ejemplo, y los índices que deben usar. Ninguna debería recorrer
+    una tabla completa."""
+    return [
+        ('listar_preguntas_por_encuesta', _consulta_preguntas_por_encuesta(1, 1, 100),
+         ['ix_questions_encuesta_pregunta']),
+        ('listar_respuestas_por_pregunta', _consulta_respuestas_por_pregunta(1, 1, 100),
+         ['ix_answers_pregunta_respuesta']),
+        ('listar_respuestas_por_usuario', _consulta_respuestas_por_usuario(1, 1, 100),
+         ['ix_answers_usuario_respuesta']),
+        ('listar_respuestas_por_encuesta', _consulta_respuestas_por_encuesta(1, 1, 100),
+         ['ix_questions_encuesta_pregunta', 'ix_answers_pregunta_respuesta']),
+        ('obtener_resultados_encuesta', _consulta_resultados_encuesta(1),
+         ['ix_questions_encuesta_pregunta']),
+        ('obtener_cambios_desde', _consulta_cambios_desde(1, 100), []),
+        ('exportar (encuesta)', _consulta_exportacion(id_encuesta=1),
+         ['ix_questions_encuesta_pregunta', 'ix_answers_pregunta_respuesta']),
+        ('exportar (fechas)', _consulta_exportacion(desde='2025-01-01', hasta='2025-02-01'),
+         ['ix_answers_fecha_registrada']),
+        ('eliminar_encuesta (respuestas)', _delete_respuestas_de_preguntas(_preguntas_de_encuesta(1)),
+         ['ix_questions_encuesta_pregunta', 'ix_answers_pregunta_respuesta']),
+        ('eliminar_encuesta (registro de cambios)', _respuestas_de_preguntas(_preguntas_de_encuesta(1)),
+         ['ix_questions_encuesta_pregunta', 'ix_answers_pregunta_respuesta']),
+        ('eliminar_usuario (conteos)', _conteos_de_usuario(1),
+         ['ix_answers_usuario_respuesta']),
+        ('purgar_encuesta (lote)', _lote_purga(_preguntas_de_encuesta(1), PURGA_TAMANO_LOTE),
+         ['ix_questions_encuesta_pregunta', 'ix_answers_pregunta_respuesta']),
+        ('buscar (tokens)', _consulta_busqueda_tokens('respuesta', ['buen', 'servicio'], None, 0, 100),
+         ['sqlite_autoindex_search_tokens_1']),
+        ('buscar (tokens, por encuesta)', _consulta_busqueda_tokens('respuesta', ['buen', 'servicio'], 1, 0, 100),
+         ['sqlite_autoindex_search_tokens_1', 'ix_questions_encuesta_pregunta']),
+        ('buscar (tokens, preguntas)', _consulta_busqueda_tokens('pregunta', ['servicio'], 1, 0, 100),
+         ['sqlite_autoindex_search_tokens_1']),
+    ]
+
+
+def verificar_planes(bind):
+    """Ejecuta EXPLAIN QUERY PLAN (solo SQLite) sobre las consultas críticas.
+
+    Devuelve una lista de (nombre, líneas del plan, problemas); una consulta
+    está bien si no recorre ninguna tabla completa y usa los índices esperados.
+    """
+    resultados = []
+    with bind.connect() as conn:
+        for nombre, stmt, indices in _consultas_criticas():
+            # render_postcompile expande los IN (...) de listas en un parámetro por valor
+            compilada = stmt.compile(dialect=conn.dialect, compile_kwargs={'render_postcompile': True})
+            parametros = tuple(compilada.params[clave] for clave in compilada.positiontup)
+            plan = [fila[3] for fila in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {compilada}', parametros)]
+            problemas = [f'recorre la tabla {m.group(1)}' for linea in plan
+                         if (m := re.match(r'SCAN (\w+)', linea)) and m.group(1) in Base.metadata.tables]
+            problemas += [f'no usa {indice}' for indice in indices
+                          if not any(re.search(rf'INDEX {indice}\b', linea) for linea in plan)]
+            resultados.append((nombre, plan, problemas))
+    return resultados
+
 
 # --- 3. Modelos del API (Spyne) ---
 
@@ -176,80 +1060,1129 @@ class Usuario(ComplexModel):
     genero = Unicode
 
 
-# --- 4. Definición del Servicio SOAP ---
+class ResultadoLote(ComplexModel):
+    """Resultado por elemento de una operación por lotes: `indice` es la
+    posición del elemento en el lote recibido."""
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    indice = Integer
+    id_respuesta = Integer
+    exito = Boolean
+    error = Unicode
+
+
+class ResultadoPregunta(ComplexModel):
+    """Número de personas que dieron una respuesta concreta a una pregunta."""
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    id_pregunta = Integer
+    texto_pregunta = Unicode
+    texto_respuesta = Unicode
+    total = Integer
+
+
+class EstadoPurga(ComplexModel):
+    """Progreso de una purga de encuesta en segundo plano. `estado` es uno de
+    pendiente, en_curso, completada o error."""
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    id_tarea = Unicode
+    id_encuesta = Integer
+    estado = Unicode
+    respuestas_eliminadas = Integer
+    preguntas_eliminadas = Integer
+    error = Unicode
+    fecha_inicio = Unicode
+    fecha_fin = Unicode
+
+
+class EstadisticasCache(ComplexModel):
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    backend = Unicode
+    entradas = Integer
+    aciertos = Integer
+    fallos = Integer
+    desalojos = Integer
+
+
+class Cambio(ComplexModel):
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    id_cambio = Integer
+    entidad = Unicode
+    id_entidad = Integer
+    operacion = Unicode
+    fecha = Unicode
+
+
+class EstadoRespuestaDiferida(ComplexModel):
+    """Situación de una respuesta aceptada en modo diferido (ver SpoolRespuestas)."""
+    __namespace__ = 'encuestas.soap.retofinal'
+
+    id_provisional = Integer
+    estado = Unicode        # 'pendiente', 'persistida' o 'rechazada'
+    id_respuesta = Integer  # id definitivo, una vez persistida
+    intentos = Integer
+    error = Unicode
+
+
+def _a_encuesta(db_enc: EncuestaDB) -> Encuesta:
+    return Encuesta(id_encuesta=db_enc.id_encuesta, titulo=db_enc.titulo, descripcion=db_enc.descripcion, fecha_creacion=str(db_enc.fecha_creacion))
+
+
+def _a_pregunta(db_preg: PreguntaDB) -> Pregunta:
+    return Pregunta(id_pregunta=db_preg.id_pregunta, id_encuesta=db_preg.id_encuesta, texto_pregunta=db_preg.texto_pregunta)
+
+
+def _a_respuesta(db_res: RespuestaDB) -> Respuesta:
+    return Respuesta(id_respuesta=db_res.id_respuesta, id_pregunta=db_res.id_pregunta, id_usuario=db_res.id_usuario, texto_respuesta=db_res.texto_respuesta, fecha_registro=str(db_res.fecha_registro))
+
+
+def _a_usuario(db_usr: UsuarioDB) -> Usuario:
+    return Usuario(id_usuario=db_usr.id_usuario, nombre=db_usr.nombre, apellidos=db_usr.apellidos, email=db_usr.email, telefono=db_usr.telefono, genero=db_usr.genero)
+
+
+def _a_cambio(db_cambio: CambioDB) -> Cambio:
+    return Cambio(id_cambio=db_cambio.id_cambio, entidad=db_cambio.entidad, id_entidad=db_cambio.id_entidad,
+                  operacion=db_cambio.operacion, fecha=str(db_cambio.fecha))
+
+
+def _a_estado_purga(tarea: TareaPurgaDB) -> EstadoPurga:
+    return EstadoPurga(id_tarea=tarea.id_tarea, id_encuesta=tarea.id_encuesta, estado=tarea.estado,
+                       respuestas_eliminadas=tarea.respuestas_eliminadas,
+                       preguntas_eliminadas=tarea.preguntas_eliminadas, error=tarea.error,
+                       fecha_inicio=str(tarea.fecha_inicio), fecha_fin=str(tarea.fecha_fin))
+
+
+def _limite_pagina(limite):
+    if not limite or limite < 1:
+        return LISTADO_LIMITE_DEFECTO
+    return min(limite, LISTADO_LIMITE_MAX)
+
+
+# --- 4. Caché de entidades ---
+
+# Las definiciones de encuestas, preguntas y usuarios casi no cambian, así que
+# las lecturas por id pasan por una caché (clave "entidad:id"). Las operaciones
+# actualizar_*/eliminar_* invalidan la entrada tras el commit.
+#   CACHE_BACKEND:       'memoria' (por proceso, por defecto), 'sqlite' (archivo
+#                        compartido entre procesos locales) o 'ninguna'.
+#   CACHE_MAX_ENTRADAS:  número máximo de entradas antes de desalojar (LRU).
+#   CACHE_TTL_SEGUNDOS:  vida máxima de una entrada; 0 = sin caducidad.
+#   CACHE_SQLITE_PATH:   archivo usado por el backend 'sqlite'.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memoria').lower()
+CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_MAX_ENTRADAS', '10000'))
+CACHE_TTL_SEGUNDOS = float(os.getenv('CACHE_TTL_SEGUNDOS', '300'))
+CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH', './cache_entidades.db')
+
+
+class CacheBackend:
+    """Interfaz de un almacén de caché. Los valores son diccionarios simples
+    (serializables a JSON) con los campos del modelo del API."""
+
+    nombre = 'base'
+    # Las generaciones se llevan por franja (crc32 de la clave módulo FRANJAS)
+    # y no por clave, para que ocupen lo mismo aunque se invaliden millones de
+    # ids. Dos claves de la misma franja comparten generación: una invalidación
+    # puede impedir guardar una carga de la otra, pero nunca deja un valor viejo.
+    FRANJAS = 4096
+
+    def __init__(self):
+        self._lock_contadores = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+
+    def _contar(self, campo, cantidad=1):
+        with self._lock_contadores:
+            setattr(self, campo, getattr(self, campo) + cantidad)
+
+    def _franja(self, clave):
+        return zlib.crc32(clave.encode('utf-8')) % self.FRANJAS
+
+    def get(self, clave):
+        """Devuelve el valor guardado o None si no existe o caducó."""
+        raise NotImplementedError
+
+    def generacion(self, clave):
+        """Generación actual de la franja de `clave`; `delete` (y `clear`) la
+        incrementan. Se lee antes de cargar el valor de la BD y se pasa a `set`."""
+        raise NotImplementedError
+
+    def set(self, clave, valor, generacion=None):
+        """Guarda `valor`. Con `generacion`, solo si la clave no se invalidó
+        desde entonces: así un lector lento no vuelve a dejar en la caché un
+        valor que una escritura ya había invalidado."""
+        raise NotImplementedError
+
+    def delete(self, clave):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoriaLRUCache(CacheBackend):
+    """Caché en memoria del proceso con desalojo LRU y TTL opcional."""
+
+    nombre = 'memoria'
+
+    def __init__(self, max_entradas=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS):
+        super().__init__()
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._generaciones = [0] * self.FRANJAS
+        self._lock = threading.Lock()
+
+    def get(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                expira, valor = entrada
+                if expira and expira < time.monotonic():
+                    del self._datos[clave]
+                    entrada = None
+                else:
+                    self._datos.move_to_end(clave)
+        self._contar('aciertos' if entrada is not None else 'fallos')
+        return None if entrada is None else valor
+
+    def generacion(self, clave):
+        with self._lock:
+            return self._generaciones[self._franja(clave)]
+
+    def set(self, clave, valor, generacion=None):
+        expira = time.monotonic() + self.ttl if self.ttl else 0
+        desalojados = 0
+        with self._lock:
+            if generacion is not None and self._generaciones[self._franja(clave)] != generacion:
+                return
+            self._datos[clave] = (expira, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                desalojados += 1
+        if desalojados:
+            self._contar('desalojos', desalojados)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+            self._generaciones[self._franja(clave)] += 1
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+            # invalida también las cargas en curso
+            self._generaciones = [generacion + 1 for generacion in self._generaciones]
+
+    def __len__(self):
+        return len(self._datos)
+
+
+class SQLiteCache(CacheBackend):
+    """Caché en un archivo SQLite local, compartida por varios procesos de la
+    misma máquina (sustituto local de un almacén tipo memcached/redis).
+
+    El orden LRU se aproxima con la columna `acceso`, que un acierto solo
+    actualiza si tiene más de ACCESO_RESOLUCION_S segundos: la mayoría de los
+    aciertos son solo lecturas y no compiten por el bloqueo de escritura del
+    archivo. Los contadores son por proceso.
+    """
+
+    nombre = 'sqlite'
+    ACCESO_RESOLUCION_S = 60
+
+    def __init__(self, ruta=CACHE_SQLITE_PATH, max_entradas=CACHE_MAX_ENTRADAS, ttl=CACHE_TTL_SEGUNDOS):
+        super().__init__()
+        self.ruta = ruta
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._conexion() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'clave TEXT PRIMARY KEY, valor TEXT NOT NULL, expira REAL NOT NULL, acceso REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_acceso ON cache (acceso)')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache_franjas ('
+                         'franja INTEGER PRIMARY KEY, generacion INTEGER NOT NULL)')
+            # Tabla de una versión anterior, con una fila por clave invalidada
+            conn.execute('DROP TABLE IF EXISTS cache_generaciones')
+
+    def _conexion(self):
+        # Una conexión por hilo; en modo WAL lectores y escritor no se bloquean
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, clave):
+        ahora = time.time()
+        conn = self._conexion()
+        fila = conn.execute('SELECT valor, expira, acceso FROM cache WHERE clave = ?', (clave,)).fetchone()
+        if fila is not None and fila[1] and fila[1] < ahora:
+            with conn:
+                conn.execute('DELETE FROM cache WHERE clave = ?', (clave,))
+            fila = None
+        elif fila is not None and ahora - fila[2] >= self.ACCESO_RESOLUCION_S:
+            with conn:
+                conn.execute('UPDATE cache SET acceso = ? WHERE clave = ?', (ahora, clave))
+        self._contar('aciertos' if fila is not None else 'fallos')
+        return None if fila is None else json.loads(fila[0])
+
+    def generacion(self, clave):
+        fila = self._conexion().execute('SELECT generacion FROM cache_franjas WHERE franja = ?',
+                                        (self._franja(clave),)).fetchone()
+        return fila[0] if fila is not None else 0
+
+    def set(self, clave, valor, generacion=None):
+        ahora = time.time()
+        expira = ahora + self.ttl if self.ttl else 0
+        conn = self._conexion()
+        with conn:
+            if generacion is None:
+                conn.execute('INSERT OR REPLACE INTO cache (clave, valor, expira, acceso) VALUES (?, ?, ?, ?)',
+                             (clave, json.dumps(valor), expira, ahora))
+            else:
+                # Comprobar la generación y guardar en la misma sentencia
+                guardada = conn.execute(
+                    'INSERT OR REPLACE INTO cache (clave, valor, expira, acceso) SELECT ?, ?, ?, ? '
+                    'WHERE COALESCE((SELECT generacion FROM cache_franjas WHERE franja = ?), 0) = ?',
+                    (clave, json.dumps(valor), expira, ahora, self._franja(clave), generacion)).rowcount
+                if not guardada:
+                    return
+            sobrantes = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entradas
+            if sobrantes > 0:
+                conn.execute('DELETE FROM cache WHERE clave IN '
+                             '(SELECT clave FROM cache ORDER BY acceso LIMIT ?)', (sobrantes,))
+        if sobrantes > 0:
+            self._contar('desalojos', sobrantes)
+
+    def delete(self, clave):
+        conn = self._conexion()
+        with conn:
+            conn.execute('DELETE FROM cache WHERE clave = ?', (clave,))
+            conn.execute('INSERT INTO cache_franjas (franja, generacion) VALUES (?, 1) '
+                         'ON CONFLICT (franja) DO UPDATE SET generacion = generacion + 1', (self._franja(clave),))
+
+    def clear(self):
+        conn = self._conexion()
+        with conn:
+            conn.execute('DELETE FROM cache')
+            # Sube la generación de todas las franjas (también las que aún no
+            # tienen fila) para invalidar las cargas en curso
+            conn.execute('WITH RECURSIVE franjas(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM franjas WHERE n + 1 < ?) '
+                         'INSERT INTO cache_franjas (franja, generacion) SELECT n, 1 FROM franjas WHERE true '
+                         'ON CONFLICT (franja) DO UPDATE SET generacion = generacion + 1', (self.FRANJAS,))
+
+    def __len__(self):
+        return self._conexion().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+def _crear_cache():
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteCache()
+    if CACHE_BACKEND in ('ninguna', 'none', 'off', ''):
+        return None
+    return MemoriaLRUCache()
+
+
+_cache_entidades = None
+_cache_creada = False
+_cache_lock = threading.Lock()
+
+
+def obtener_cache():
+    """Caché de entidades del proceso, o None si CACHE_BACKEND la desactiva.
+    Se crea en el primer uso (con 'sqlite', abre o crea el archivo)."""
+    global _cache_entidades, _cache_creada
+    if not _cache_creada:
+        with _cache_lock:
+            if not _cache_creada:
+                _cache_entidades = _crear_cache()
+                _cache_creada = True
+    return _cache_entidades
+
+
+def _obtener_cacheado(ctx, entidad: str, id_, modelo, cargar):
+    """Lectura a través de la caché: `cargar(db)` devuelve el objeto del API
+    (o lanza una excepción) cuando la entrada no está cacheada.
+
+    La sesión de lectura puede ser de una réplica; lo leído de una réplica no
+    se guarda en la caché (podría ir por detrás de una escritura ya
+    invalidada). Un cliente dentro de su ventana de lectura propia no usa la
+    caché: lee de la principal.
+    """
+    def leer():
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            return cargar(db), not db.info.get('replica', False)
+        finally:
+            if close_after:
+                db.close()
+
+    cache_entidades = obtener_cache()
+    if cache_entidades is None or enrutador_lecturas.en_lectura_propia(_clave_cliente(ctx)):
+        return leer()[0]
+    clave = f'{entidad}:{id_}'
+    valor = cache_entidades.get(clave)
+    if valor is not None:
+        return modelo(**valor)
+    # La generación se lee antes de cargar: si una escritura invalida la clave
+    # mientras tanto, el valor cargado puede ser el anterior y no se guarda
+    generacion = cache_entidades.generacion(clave)
+    obj, de_principal = leer()
+    if de_principal:
+        cache_entidades.set(clave, {campo: getattr(obj, campo) for campo in modelo._type_info}, generacion)
+    return obj
+
+
+def _invalidar_cache(entidad: str, *ids):
+    cache_entidades = obtener_cache()
+    if cache_entidades is None:
+        return
+    for id_ in ids:
+        cache_entidades.delete(f'{entidad}:{id_}')
+
+
+# --- 5. Búsqueda de texto ---
+
+# buscar_respuestas / buscar_preguntas buscan por palabras en `texto_respuesta`
+# y `text_pregunta` con un índice invertido. Dos implementaciones:
+#   'fts5':   tablas virtuales FTS5 de SQLite, sincronizadas con triggers.
+#   'tokens': tabla portable `search_tokens` (palabra -> ids), actualizada desde
+#             `_registrar_cambios` en la misma transacción que el cambio.
+# BUSQUEDA_BACKEND: 'auto' (fts5 en SQLite si está disponible; si no, tokens),
+# 'fts5' o 'tokens'. Al cambiar de backend: `python3 app.py reindexar-busqueda`.
+BUSQUEDA_BACKEND = os.getenv('BUSQUEDA_BACKEND', 'auto').lower()
+
+# entidad -> (modelo, columna id, columna de texto)
+_ENTIDADES_BUSQUEDA = {
+    'respuesta': (RespuestaDB, RespuestaDB.id_respuesta, RespuestaDB.texto_respuesta),
+    'pregunta': (PreguntaDB, PreguntaDB.id_pregunta, PreguntaDB.texto_pregunta),
+}
+
+
+def _tokens(texto):
+    """Palabras de un texto en minúsculas y sin acentos (como el tokenizador
+    `unicode61 remove_diacritics` de FTS5)."""
+    if not texto:
+        return []
+    normalizado = ''.join(c for c in unicodedata.normalize('NFKD', texto.lower()) if not unicodedata.combining(c))
+    return [token[:64] for token in re.findall(r'\w+', normalizado)]
+
+
+def _filtrar_por_encuesta(consulta, entidad, id_encuesta):
+    if not id_encuesta:
+        return consulta
+    if entidad == 'pregunta':
+        return consulta.filter(PreguntaDB.id_encuesta == id_encuesta)
+    return consulta.filter(RespuestaDB.id_pregunta.in_(
+        select(PreguntaDB.id_pregunta).where(PreguntaDB.id_encuesta == id_encuesta)))
+
+
+class IndiceBusqueda:
+    """Interfaz del índice de búsqueda de texto."""
+
+    nombre = 'base'
+
+    def __init__(self):
+        self._preparado = False
+        self._lock = threading.Lock()
+
+    def preparar(self, engine):
+        """Crea lo que el índice necesite además de las tablas de los modelos."""
+
+    def asegurar(self, engine):
+        """Llama a `preparar` una vez por proceso, antes de la primera búsqueda:
+        una BD existente puede no tener aún las tablas del índice."""
+        if self._preparado:
+            return
+        with self._lock:
+            if not self._preparado:
+                self.preparar(engine)
+                self._preparado = True
+
+    def sincronizar(self, db: Session, entidad, operacion, ids):
+        """Refleja en el índice un cambio (mismos argumentos que `_registrar_cambios`)."""
+
+    def reindexar(self, db: Session):
+        """Reconstruye el índice completo a partir de las tablas (hace commit)."""
+        raise NotImplementedError
+
+    def buscar(self, db: Session, entidad, texto, id_encuesta, desplazamiento, limite):
+        """Objetos ORM que contienen todas las palabras de `texto`, del más al
+        menos relevante."""
+        raise NotImplementedError
+
+
+class IndiceFTS5(IndiceBusqueda):
+    """Tablas FTS5 de contenido externo sobre `answers` y `questions`. Los
+    triggers las mantienen al día con cualquier INSERT/UPDATE/DELETE, incluidos
+    los borrados por conjuntos de la cascada y la purga."""
+
+    nombre = 'fts5'
+    # entidad -> (tabla FTS, tabla de contenido, columna id, columna de texto)
+    TABLAS = {
+        'respuesta': ('answers_fts', 'answers', 'id_respuesta', 'texto_respuesta'),
+        'pregunta': ('questions_fts', 'questions', 'id_pregunta', 'text_pregunta'),
+    }
+
+    def preparar(self, engine):
+        with engine.begin() as conn:
+            for fts, tabla, id_, texto in self.TABLAS.values():
+                existia = conn.exec_driver_sql(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)).first()
+                conn.exec_driver_sql(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({texto}, content='{tabla}', "
+                    f"content_rowid='{id_}', tokenize='unicode61 remove_diacritics 2')")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabla} BEGIN "
+                    f"INSERT INTO {fts}(rowid, {texto}) VALUES (new.{id_}, new.{texto}); END")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabla} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, {texto}) VALUES ('delete', old.{id_}, old.{texto}); END")
+                conn.exec_driver_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {texto} ON {tabla} BEGIN "
+                    f"INSERT INTO {fts}({fts}, rowid, {texto}) VALUES ('delete', old.{id_}, old.{texto}); "
+                    f"INSERT INTO {fts}(rowid, {texto}) VALUES (new.{id_}, new.{texto}); END")
+                if not existia:
+                    # Indexar las filas que ya existían
+                    conn.exec_driver_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+    def reindexar(self, db: Session):
+        for fts, _, _, _ in self.TABLAS.values():
+            db.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        safe_commit(db)
+
+    def buscar(self, db: Session, entidad, texto, id_encuesta, desplazamiento, limite):
+        tokens = _tokens(texto)
+        if not tokens:
+            return []
+        modelo, columna_id, _ = _ENTIDADES_BUSQUEDA[entidad]
+        nombre_fts = self.TABLAS[entidad][0]
+        fts = table(nombre_fts, column('rowid'), column('rank'))
+        # Cada palabra entre comillas: se buscan todas (AND) sin interpretar la
+        # sintaxis de consultas de FTS5
+        consulta_fts = ' '.join(f'"{token}"' for token in tokens)
+        consulta = (db.query(modelo)
+                    .join(fts, fts.c.rowid == columna_id)
+                    .filter(literal_column(nombre_fts).op('MATCH')(consulta_fts)))
+        consulta = _filtrar_por_encuesta(consulta, entidad, id_encuesta)
+        return consulta.order_by(fts.c.rank, columna_id).offset(desplazamiento or 0).limit(limite).all()
+
+
+class IndiceTokens(IndiceBusqueda):
+    """Índice invertido en la tabla `search_tokens`, válido en cualquier motor.
+    La relevancia es el número de apariciones de las palabras buscadas."""
+
+    nombre = 'tokens'
+
+    def sincronizar(self, db: Session, entidad, operacion, ids):
+        if entidad not in _ENTIDADES_BUSQUEDA or (isinstance(ids, list) and not ids):
+            return
+        tabla = TokenBusquedaDB.__table__
+        if operacion != 'crear':
+            db.execute(delete(tabla).where(tabla.c.entidad == entidad, tabla.c.id_entidad.in_(ids)))
+        if operacion != 'eliminar':
+            # enviar antes los cambios pendientes del ORM (p. ej. actualizar_respuesta)
+            db.flush()
+            _, columna_id, columna_texto = _ENTIDADES_BUSQUEDA[entidad]
+            self._indexar(db, entidad, db.execute(select(columna_id, columna_texto).where(columna_id.in_(ids))))
+
+    def _indexar(self, db: Session, entidad, filas):
+        entradas = [{'entidad': entidad, 'token': token, 'id_entidad': id_, 'frecuencia': veces}
+                    for id_, texto in filas for token, veces in Counter(_tokens(texto)).items()]
+        if entradas:
+            db.execute(insert(TokenBusquedaDB.__table__), entradas)
+
+    def reindexar(self, db: Session, bloque=1000):
+        db.execute(delete(TokenBusquedaDB.__table__))
+        for entidad, (_, columna_id, columna_texto) in _ENTIDADES_BUSQUEDA.items():
+            filas = db.execute(select(columna_id, columna_texto).execution_options(yield_per=bloque))
+            for particion in filas.partitions():
+                self._indexar(db, entidad, particion)
+        safe_commit(db)
+
+    def buscar(self, db: Session, entidad, texto, id_encuesta, desplazamiento, limite):
+        tokens = sorted(set(_tokens(texto)))
+        if not tokens:
+            return []
+        return db.scalars(_consulta_busqueda_tokens(entidad, tokens, id_encuesta, desplazamiento, limite)).all()
+
+
+def _consulta_busqueda_tokens(entidad, tokens, id_encuesta, desplazamiento, limite):
+    """SELECT de `IndiceTokens.buscar`: entidades con todos los `tokens`
+    (distintos), por número de apariciones."""
+    modelo, columna_id, _ = _ENTIDADES_BUSQUEDA[entidad]
+    # Agrupar por `id_entidad + 0` y no por la columna: si no, SQLite prefiere
+    # recorrer todos los tokens de la entidad por ix_search_tokens_entidad_id
+    # (ya ordenado por id) a buscar cada palabra por la clave primaria
+    id_entidad = (TokenBusquedaDB.id_entidad + 0).label('id_entidad')
+    coincidencias = (select(id_entidad, func.sum(TokenBusquedaDB.frecuencia).label('puntos'))
+                     .where(TokenBusquedaDB.entidad == entidad, TokenBusquedaDB.token.in_(tokens))
+                     .group_by(id_entidad)
+                     .having(func.count() == len(tokens))
+                     .subquery())
+    consulta = select(modelo).join(coincidencias, coincidencias.c.id_entidad == columna_id)
+    consulta = _filtrar_por_encuesta(consulta, entidad, id_encuesta)
+    return (consulta.order_by(coincidencias.c.puntos.desc(), columna_id)
+            .offset(desplazamiento or 0).limit(limite))
+
+
+def _fts5_disponible():
+    try:
+        conexion = sqlite3.connect(':memory:')
+        try:
+            conexion.execute('CREATE VIRTUAL TABLE prueba USING fts5(texto)')
+        finally:
+            conexion.close()
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def _crear_indice_busqueda():
+    if DATABASE_URL.startswith('sqlite') and BUSQUEDA_BACKEND in ('auto', 'fts5') and _fts5_disponible():
+        return IndiceFTS5()
+    if BUSQUEDA_BACKEND == 'fts5':
+        logging.warning('FTS5 no disponible con esta base de datos: se usa el índice portable de tokens')
+    return IndiceTokens()
+
+
+indice_busqueda = _crear_indice_busqueda()
+
+
+# --- 6. Purga de encuestas en segundo plano ---
+
+# Para encuestas muy grandes, `purgar_encuesta` borra las respuestas en
+# transacciones de tamaño acotado desde un hilo de fondo, de modo que no se
+# mantienen bloqueos largos ni se ocupa un hilo de petición. El estado de cada
+# tarea se guarda en `purge_tasks` (ver TareaPurgaDB).
+#   PURGA_TAMANO_LOTE: respuestas borradas por transacción.
+#   PURGA_PAUSA_MS:    pausa entre lotes para dejar paso a otras escrituras.
+PURGA_TAMANO_LOTE = int(os.getenv('PURGA_TAMANO_LOTE', '5000'))
+PURGA_PAUSA_MS = float(os.getenv('PURGA_PAUSA_MS', '10'))
+
+_lock_purga = threading.Lock()
+_ejecutor_purga = None
+
+
+def _ejecutar_escritura(aplicar):
+    """Escritura fuera de una petición SOAP (hilos de fondo)."""
+    if escritor_agrupado is not None:
+        return escritor_agrupado.ejecutar(aplicar)
+    db = SessionLocal()
+    try:
+        valor = aplicar(db)
+        safe_commit(db)
+        return valor
+    finally:
+        db.close()
+
+
+def _actualizar_tarea(db: Session, id_tarea, **campos):
+    """UPDATE de la fila de la tarea dentro de la transacción de `db` (sin commit)."""
+    db.execute(update(TareaPurgaDB).where(TareaPurgaDB.id_tarea == id_tarea).values(**campos),
+               execution_options={'synchronize_session': False})
+
+
+def _purgar_encuesta(id_tarea, id_encuesta, tamano_lote):
+    preguntas = _preguntas_de_encuesta(id_encuesta)
+    try:
+        # Los conteos de una encuesta que se está borrando ya no tienen sentido
+        def empezar(db):
+            _actualizar_tarea(db, id_tarea, estado='en_curso')
+            db.execute(delete(ConteoRespuestaDB).where(ConteoRespuestaDB.id_pregunta.in_(preguntas)),
+                       execution_options={'synchronize_session': False})
+
+        def borrar_lote(db):
+            ids = list(db.scalars(_lote_purga(preguntas, tamano_lote)))
+            if ids:
+                _registrar_cambios(db, 'respuesta', 'eliminar', ids)
+                db.execute(delete(RespuestaDB).where(RespuestaDB.id_respuesta.in_(ids)),
+                           execution_options={'synchronize_session': False})
+                _actualizar_tarea(db, id_tarea, respuestas_eliminadas=TareaPurgaDB.respuestas_eliminadas + len(ids))
+            return len(ids)
+
+        # Último paso en una sola transacción: respuestas llegadas durante la
+        # purga, preguntas, la encuesta y el fin de la tarea
+        def terminar(db):
+            ids_preguntas = borrar_encuesta_en_cascada(db, id_encuesta)
+            _actualizar_tarea(db, id_tarea, estado='completada', preguntas_eliminadas=len(ids_preguntas),
+                              fecha_fin=func.current_timestamp())
+            return ids_preguntas
+
+        _ejecutar_escritura(empezar)
+        while _ejecutar_escritura(borrar_lote):
+            time.sleep(PURGA_PAUSA_MS / 1000.0)
+        ids_preguntas = _ejecutar_escritura(terminar)
+        _invalidar_cache('encuesta', id_encuesta)
+        _invalidar_cache('pregunta', *ids_preguntas)
+    except Exception as e:
+        logging.exception(f"Error purgando la encuesta {id_encuesta}")
+        try:
+            _ejecutar_escritura(lambda db: _actualizar_tarea(db, id_tarea, estado='error',
+                                                             error=str(getattr(e, 'faultstring', e)),
+                                                             fecha_fin=func.current_timestamp()))
+        except Exception:
+            logging.exception(f"No se pudo guardar el error de la tarea de purga {id_tarea}")
+
+
+def iniciar_purga_encuesta(id_encuesta, tamano_lote=None):
+    """Registra y lanza en segundo plano la purga de una encuesta; devuelve el id de tarea."""
+    global _ejecutor_purga
+    id_tarea = uuid.uuid4().hex
+    _ejecutar_escritura(lambda db: db.add(TareaPurgaDB(id_tarea=id_tarea, id_encuesta=id_encuesta,
+                                                       estado='pendiente', respuestas_eliminadas=0,
+                                                       preguntas_eliminadas=0)))
+    with _lock_purga:
+        if _ejecutor_purga is None:
+            # Un solo hilo: las purgas se ejecutan de una en una
+            _ejecutor_purga = ThreadPoolExecutor(max_workers=1, thread_name_prefix='purga')
+    _ejecutor_purga.submit(_purgar_encuesta, id_tarea, id_encuesta, tamano_lote or PURGA_TAMANO_LOTE)
+    return id_tarea
+
+
+def estado_purga(id_tarea):
+    """Estado de la tarea (TareaPurgaDB) leído de la BD principal, o None."""
+    db = SessionLocal()
+    try:
+        return db.get(TareaPurgaDB, id_tarea)
+    finally:
+        db.close()
+
+
+# --- 7. Escritura diferida de respuestas ---
+
+# Modo opcional "aceptar y después persistir" para `crear_respuesta`: la
+# respuesta validada se guarda en un spool SQLite local (durable) y se confirma
+# en el acto con un id provisional; un pool de hilos la vuelca después a la BD
+# principal por lotes, con reintentos. Así la latencia de crear_respuesta no
+# depende de la BD principal y un corte breve de ésta no pierde respuestas.
+# Varios procesos pueden compartir el mismo archivo de spool.
+#   RESPUESTAS_DIFERIDAS:   1 para activar el modo (desactivado por defecto).
+#   SPOOL_RUTA:             archivo SQLite del spool.
+#   SPOOL_MAX_PENDIENTES:   pendientes a partir de los cuales crear_respuesta
+#                           responde con un Fault (contrapresión).
+#   SPOOL_LOTE:             respuestas por transacción en la BD principal.
+#   SPOOL_HILOS:            hilos que vacían el spool en cada proceso.
+#   SPOOL_ESPERA_MS:        espera de los hilos cuando no hay nada pendiente.
+#   SPOOL_REINTENTO_MAX_S:  tope de la espera exponencial entre reintentos.
+#   SPOOL_RETENCION_S:      tiempo que se conservan las entradas ya volcadas
+#                           (para `obtener_respuesta_diferida`).
+RESPUESTAS_DIFERIDAS = os.getenv('RESPUESTAS_DIFERIDAS', '0').lower() in ('1', 'true', 'si', 'yes')
+SPOOL_RUTA = os.getenv('SPOOL_RUTA', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool_respuestas.db'))
+SPOOL_MAX_PENDIENTES = int(os.getenv('SPOOL_MAX_PENDIENTES', '100000'))
+SPOOL_LOTE = int(os.getenv('SPOOL_LOTE', '500'))
+SPOOL_HILOS = int(os.getenv('SPOOL_HILOS', '2'))
+SPOOL_ESPERA_MS = float(os.getenv('SPOOL_ESPERA_MS', '200'))
+SPOOL_REINTENTO_MAX_S = float(os.getenv('SPOOL_REINTENTO_MAX_S', '60'))
+SPOOL_RETENCION_S = float(os.getenv('SPOOL_RETENCION_S', '86400'))
+
+
+class SpoolRespuestas:
+    """Cola durable de respuestas aceptadas pendientes de volcar a la BD principal.
+
+    Cada entrada pasa de 'pendiente' a 'persistida' (con su id_respuesta
+    definitivo) o a 'rechazada' (la pregunta o el usuario no existen). Un fallo
+    de la BD principal no rechaza nada: el lote vuelve a quedar pendiente y se
+    reintenta con espera exponencial; las entradas que fallan varias veces se
+    reintentan de una en una para que una fila problemática no bloquee al
+    resto. Un hilo reclama un lote moviendo su `proximo_intento` al futuro con
+    un solo UPDATE, de modo que ningún otro hilo o proceso lo toma mientras
+    tanto (y, si el hilo muere, el lote vuelve a estar disponible al vencer el
+    plazo). Si el proceso cae entre el commit en la BD principal y la marca en
+    el spool, al reintentar el lote `spooled_answers` indica qué entradas ya se
+    guardaron, de modo que ninguna se inserta dos veces. Esas filas se borran
+    en cuanto el spool queda marcado; `depurar` recoge las que se quedaran
+    atrás por un fallo.
+    """
+
+    RECLAMO_S = 300       # plazo de un lote reclamado
+    INTENTOS_AISLAR = 3   # a partir de aquí, la entrada se reintenta sola
+
+    def __init__(self, ruta=SPOOL_RUTA, max_pendientes=SPOOL_MAX_PENDIENTES, lote=SPOOL_LOTE, hilos=SPOOL_HILOS,
+                 espera_ms=SPOOL_ESPERA_MS, reintento_max=SPOOL_REINTENTO_MAX_S, retencion=SPOOL_RETENCION_S):
+        self.ruta = ruta
+        self.max_pendientes = max_pendientes
+        self.lote = max(1, lote)
+        self.hilos = max(1, hilos)
+        self.espera = espera_ms / 1000.0
+        self.reintento_max = reintento_max
+        self.retencion = retencion
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._hilos = []
+        self._aviso = threading.Event()
+        self._detener = threading.Event()
+        # Recuento de pendientes para la contrapresión: se relee como mucho una
+        # vez por segundo y entre tanto se estima con las altas de este proceso
+        self._pendientes = 0
+        self._pendientes_leido = None
+        self._ultima_depuracion = 0.0
+        self.origen = None
+        self.persistidas = 0
+        self.rechazadas = 0
+        self.reintentos = 0
+
+    def _conexion(self):
+        # Una conexión por hilo (y por proceso: no se heredan tras el fork), en
+        # modo autocommit; WAL permite leer mientras otro hilo escribe
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Confirmar al cliente es prometer que la respuesta no se pierde
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.execute('CREATE TABLE IF NOT EXISTS spool_respuestas ('
+                         'id_provisional INTEGER PRIMARY KEY AUTOINCREMENT, id_pregunta INTEGER NOT NULL, '
+                         'id_usuario INTEGER, texto_respuesta TEXT NOT NULL, fecha_aceptada TEXT NOT NULL, '
+                         "estado TEXT NOT NULL DEFAULT 'pendiente', intentos INTEGER NOT NULL DEFAULT 0, "
+                         'proximo_intento REAL NOT NULL DEFAULT 0, id_respuesta INTEGER, error TEXT, fecha_fin REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_spool_estado ON spool_respuestas '
+                         '(estado, proximo_intento, id_provisional)')
+            conn.execute('CREATE TABLE IF NOT EXISTS spool_meta (clave TEXT PRIMARY KEY, valor TEXT NOT NULL)')
+            conn.execute("INSERT OR IGNORE INTO spool_meta (clave, valor) VALUES ('origen', ?)", (uuid.uuid4().hex,))
+            self.origen = conn.execute("SELECT valor FROM spool_meta WHERE clave = 'origen'").fetchone()[0]
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def iniciar(self):
+        """Arranca los hilos que vacían el spool (uno por proceso tras el fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._aviso = threading.Event()
+            self._detener = threading.Event()
+            self._hilos = [threading.Thread(target=self._bucle, name=f'spool-respuestas-{i}', daemon=True)
+                           for i in range(self.hilos)]
+            for hilo in self._hilos:
+                hilo.start()
+
+    def detener(self, espera=10.0):
+        """Pide a los hilos que paren tras el lote en curso y los espera."""
+        if self._pid != os.getpid():
+            return
+        self._detener.set()
+        self._aviso.set()
+        limite = time.monotonic() + espera
+        for hilo in self._hilos:
+            hilo.join(max(0.0, limite - time.monotonic()))
+        self._pid = None
+
+    def pendientes(self, releer=False):
+        ahora = time.monotonic()
+        if releer or self._pendientes_leido is None or ahora - self._pendientes_leido >= 1.0:
+            total = self._conexion().execute(
+                "SELECT COUNT(*) FROM spool_respuestas WHERE estado = 'pendiente'").fetchone()[0]
+            with self._lock:
+                self._pendientes, self._pendientes_leido = total, ahora
+        return self._pendientes
+
+    def aceptar(self, id_pregunta, id_usuario, texto_respuesta):
+        """Guarda una respuesta ya validada y devuelve (id provisional, fecha de
+        aceptación). Lanza un Fault si el spool está lleno."""
+        self.iniciar()
+        if self.pendientes() >= self.max_pendientes:
+            raise Fault(faultcode='Server',
+                        faultstring=f'Hay demasiadas respuestas pendientes de guardar ({self.max_pendientes}); '
+                                    f'reintenta más tarde')
+        # Misma referencia que CURRENT_TIMESTAMP en la BD: UTC sin zona
+        fecha = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        id_provisional = self._conexion().execute(
+            'INSERT INTO spool_respuestas (id_pregunta, id_usuario, texto_respuesta, fecha_aceptada) '
+            'VALUES (?, ?, ?, ?)', (id_pregunta, id_usuario, texto_respuesta, str(fecha))).lastrowid
+        with self._lock:
+            self._pendientes += 1
+        self._aviso.set()
+        return id_provisional, fecha
+
+    def estado(self, id_provisional):
+        fila = self._conexion().execute(
+            'SELECT id_provisional, estado, id_respuesta, intentos, error FROM spool_respuestas '
+            'WHERE id_provisional = ?', (id_provisional,)).fetchone()
+        if fila is None:
+            return None
+        return dict(zip(('id_provisional', 'estado', 'id_respuesta', 'intentos', 'error'), fila))
+
+    def _reclamar(self):
+        conn = self._conexion()
+        ahora = time.time()
+        primera = conn.execute(
+            "SELECT intentos FROM spool_respuestas WHERE estado = 'pendiente' AND proximo_intento <= ? "
+            "ORDER BY id_provisional LIMIT 1", (ahora,)).fetchone()
+        if primera is None:
+            return []
+        limite = 1 if primera[0] >= self.INTENTOS_AISLAR else self.lote
+        filas = conn.execute(
+            'UPDATE spool_respuestas SET proximo_intento = ?, intentos = intentos + 1 '
+            'WHERE id_provisional IN (SELECT id_provisional FROM spool_respuestas '
+            "WHERE estado = 'pendiente' AND proximo_intento <= ? ORDER BY id_provisional LIMIT ?) "
+            'RETURNING id_provisional, id_pregunta, id_usuario, texto_respuesta, fecha_aceptada, intentos',
+            (ahora + self.RECLAMO_S, ahora, limite)).fetchall()
+        return sorted(filas)
+
+    def _volcar(self, db: Session, filas):
+        """Inserta en la BD principal las entradas válidas de un lote (sin commit).
+
+        Devuelve ({id_provisional: id_respuesta}, {id_provisional: error}).
+        """
+        tabla = RespuestaDiferidaDB.__table__
+        # Entradas que un proceso caído ya guardó sin llegar a marcarlas
+        guardadas = dict(db.execute(select(tabla.c.id_provisional, tabla.c.id_respuesta).where(
+            tabla.c.origen == self.origen, tabla.c.id_provisional.in_([fila[0] for fila in filas]))).all())
+        filas = [fila for fila in filas if fila[0] not in guardadas]
+        preguntas, usuarios = _ids_existentes(db, {fila[1] for fila in filas}, {fila[2] for fila in filas if fila[2]})
+        validas, rechazadas = [], {}
+        for id_provisional, id_pregunta, id_usuario, texto, fecha, _ in filas:
+            if id_pregunta not in preguntas:
+                rechazadas[id_provisional] = f"Pregunta no encontrada con id: {id_pregunta}"
+            elif id_usuario and id_usuario not in usuarios:
+                rechazadas[id_provisional] = f"Usuario no encontrado con id: {id_usuario}"
+            else:
+                validas.append((id_provisional, {'id_pregunta': id_pregunta, 'id_usuario': id_usuario,
+                                                 'texto_respuesta': texto,
+                                                 'fecha_registro': datetime.fromisoformat(fecha)}))
+        persistidas = {}
+        if validas:
+            filas_bd = [fila for _, fila in validas]
+            ids = _insertar_respuestas(db, filas_bd)
+            _ajustar_conteos(db, Counter((fila['id_pregunta'], fila['texto_respuesta']) for fila in filas_bd))
+            _registrar_cambios(db, 'respuesta', 'crear', ids)
+            persistidas = {id_provisional: id_respuesta for (id_provisional, _), id_respuesta in zip(validas, ids)}
+            db.execute(insert(tabla), [{'origen': self.origen, 'id_provisional': id_provisional,
+                                        'id_respuesta': id_respuesta}
+                                       for id_provisional, id_respuesta in persistidas.items()])
+        persistidas.update(guardadas)
+        return persistidas, rechazadas
+
+    def vaciar_lote(self):
+        """Reclama un lote y lo vuelca a la BD principal en una transacción.
+        Devuelve cuántas entradas se resolvieron (0 si no había o si falló)."""
+        filas = self._reclamar()
+        if not filas:
+            return 0
+        conn = self._conexion()
+        try:
+            persistidas, rechazadas = _ejecutar_escritura(lambda db: self._volcar(db, filas))
+        except Exception as e:
+            intentos = max(fila[5] for fila in filas)
+            espera = min(self.reintento_max, 0.5 * 2 ** min(intentos - 1, 16))
+            conn.executemany('UPDATE spool_respuestas SET proximo_intento = ? WHERE id_provisional = ?',
+                             [(time.time() + espera, fila[0]) for fila in filas])
+            with self._lock:
+                self.reintentos += 1
+            logging.warning(f"No se pudieron guardar {len(filas)} respuestas del spool (intento {intentos}); "
+                            f"nuevo intento en {espera:.1f} s: {getattr(e, 'faultstring', e)}")
+            return 0
+
+        fin = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany("UPDATE spool_respuestas SET estado = 'persistida', id_respuesta = ?, fecha_fin = ? "
+                             "WHERE id_provisional = ?",
+                             [(id_respuesta, fin, id_) for id_, id_respuesta in persistidas.items()])
+            conn.executemany("UPDATE spool_respuestas SET estado = 'rechazada', error = ?, fecha_fin = ? "
+                             "WHERE id_provisional = ?", [(error, fin, id_) for id_, error in rechazadas.items()])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        for id_, error in rechazadas.items():
+            logging.warning(f"Respuesta diferida {id_} rechazada: {error}")
+        with self._lock:
+            self.persistidas += len(persistidas)
+            self.rechazadas += len(rechazadas)
+            self._pendientes = max(0, self._pendientes - len(filas))
+        if persistidas:
+            # Marcadas en el spool: ya no se reintentan, sus filas sobran
+            tabla = RespuestaDiferidaDB.__table__
+            try:
+                _ejecutar_escritura(lambda db: db.execute(delete(tabla).where(
+                    tabla.c.origen == self.origen, tabla.c.id_provisional.in_(list(persistidas)))))
+            except Exception as e:
+                logging.warning(f"No se pudieron borrar {len(persistidas)} filas de spooled_answers "
+                                f"(se reintentará al depurar): {getattr(e, 'faultstring', e)}")
+        return len(filas)
+
+    def depurar(self):
+        """Borra las entradas ya resueltas con más de `retencion` segundos y, en
+        la BD principal, las filas de `spooled_answers` de este spool anteriores
+        a la entrada pendiente más antigua (ya no se van a reintentar)."""
+        conn = self._conexion()
+        borradas = conn.execute("DELETE FROM spool_respuestas WHERE estado != 'pendiente' AND fecha_fin < ?",
+                                (time.time() - self.retencion,)).rowcount
+        primera = conn.execute("SELECT MIN(id_provisional) FROM spool_respuestas WHERE estado = 'pendiente'").fetchone()[0]
+        tabla = RespuestaDiferidaDB.__table__
+        condicion = tabla.c.origen == self.origen
+        if primera is not None:
+            condicion = condicion & (tabla.c.id_provisional < primera)
+        _ejecutar_escritura(lambda db: db.execute(delete(tabla).where(condicion)))
+        return borradas
+
+    def _bucle(self):
+        detener, aviso = self._detener, self._aviso
+        while not detener.is_set():
+            try:
+                resueltas = self.vaciar_lote()
+                if not resueltas and time.monotonic() - self._ultima_depuracion >= 60:
+                    self._ultima_depuracion = time.monotonic()
+                    self.depurar()
+            except Exception:
+                logging.exception('Error inesperado vaciando el spool de respuestas')
+                resueltas = 0
+            if not resueltas:
+                aviso.wait(self.espera)
+                aviso.clear()
+
+
+spool_respuestas = SpoolRespuestas() if RESPUESTAS_DIFERIDAS else None
+
+
+# --- 8. Definición del Servicio SOAP ---
 
 class EncuestaService(ServiceBase):
     """Servicio SOAP que agrupa operaciones CRUD para encuestas, preguntas,
     respuestas y usuarios."""
 
     @staticmethod
-    def _get_db(ctx):
+    def _get_db(ctx, solo_lectura=False):
+        """Sesión de la petición. Las lecturas (`solo_lectura=True`) pueden ir a
+        una réplica; las escrituras siempre usan la BD principal."""
         if not hasattr(ctx, 'udc') or ctx.udc is None:
             ctx.udc = type('UDC', (), {})()
 
-        db = getattr(ctx.udc, 'db', None)
+        atributo = 'db_lectura' if solo_lectura else 'db'
+        db = getattr(ctx.udc, atributo, None)
         if db is None:
-            db = SessionLocal()
-            ctx.udc.db = db
+            db = enrutador_lecturas.sesion_lectura(_clave_cliente(ctx)) if solo_lectura else SessionLocal()
+            setattr(ctx.udc, atributo, db)
             return db, True
         return db, False
 
+    @staticmethod
+    def _escribir(ctx, aplicar, construir=None, diagnosticar=None):
+        """Ejecuta una escritura: `aplicar(db)` hace los cambios (sin commit) y
+        `construir(valor)` arma la respuesta antes del commit (ver
+        `_aplicar_escritura`). Si la BD rechaza la escritura por integridad,
+        `diagnosticar(db)` da el mensaje de error (ver `_error_de_integridad`).
+
+        Con el escritor agrupado activo (perfil SQLite 'rendimiento') la escritura
+        se delega a él; si no, se usa la sesión de la petición.
+        """
+        if escritor_agrupado is not None:
+            resultado = escritor_agrupado.ejecutar(aplicar, construir, diagnosticar)
+        else:
+            db, close_after = EncuestaService._get_db(ctx)
+            try:
+                try:
+                    resultado = _aplicar_escritura(db, aplicar, construir)
+                except IntegrityError as e:
+                    db.rollback()
+                    raise _error_de_integridad(db, e, diagnosticar)
+                safe_commit(db)
+            finally:
+                if close_after:
+                    db.close()
+        # Lecturas posteriores de este cliente irán a la principal durante un tiempo
+        enrutador_lecturas.registrar_escritura(_clave_cliente(ctx))
+        return resultado
+
     # --- Encuestas ---
     @rpc(Encuesta, _returns=Encuesta, _body_style='wrapped', _out_variable_name='encuesta_creada')
     def crear_encuesta(ctx, encuesta: Encuesta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not encuesta.titulo:
-                raise ValueError("'titulo' es obligatorio para crear una encuesta")
+        if not encuesta.titulo:
+            raise ValueError("'titulo' es obligatorio para crear una encuesta")
+
+        def aplicar(db):
             db_enc = EncuestaDB(titulo=encuesta.titulo, descripcion=encuesta.descripcion)
             db.add(db_enc)
-            safe_commit(db)
-            db.refresh(db_enc)
-            return Encuesta(id_encuesta=db_enc.id_encuesta, titulo=db_enc.titulo, descripcion=db_enc.descripcion, fecha_creacion=str(db_enc.fecha_creacion))
-        finally:
-            if close_after:
-                db.close()
+            db.flush()
+            _registrar_cambios(db, 'encuesta', 'crear', [db_enc.id_encuesta])
+            return db_enc
+
+        return EncuestaService._escribir(ctx, aplicar, _a_encuesta)
 
     @rpc(Integer, _returns=Encuesta, _body_style='wrapped')
     def obtener_encuesta(ctx, id_encuesta: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
+        def cargar(db):
             db_enc = db.query(EncuestaDB).filter(EncuestaDB.id_encuesta == id_encuesta).first()
             if db_enc is None:
                 raise ValueError(f"Encuesta no encontrada con id: {id_encuesta}")
-            return Encuesta(id_encuesta=db_enc.id_encuesta, titulo=db_enc.titulo, descripcion=db_enc.descripcion, fecha_creacion=str(db_enc.fecha_creacion))
-        finally:
-            if close_after:
-                db.close()
+            return _a_encuesta(db_enc)
+
+        return _obtener_cacheado(ctx, 'encuesta', id_encuesta, Encuesta, cargar)
 
     @rpc(Encuesta, _returns=Encuesta, _body_style='wrapped')
     def actualizar_encuesta(ctx, encuesta_actualizada: Encuesta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not encuesta_actualizada.id_encuesta:
-                raise ValueError("'id_encuesta' es requerido para actualizar")
-            db_enc = db.query(EncuestaDB).filter(EncuestaDB.id_encuesta == encuesta_actualizada.id_encuesta).first()
+        if not encuesta_actualizada.id_encuesta:
+            raise ValueError("'id_encuesta' es requerido para actualizar")
+
+        def aplicar(db):
+            db_enc = _actualizar_devolviendo(db, EncuestaDB, EncuestaDB.id_encuesta, encuesta_actualizada.id_encuesta,
+                                             {'titulo': encuesta_actualizada.titulo,
+                                              'descripcion': encuesta_actualizada.descripcion})
             if db_enc is None:
                 raise ValueError(f"Encuesta no encontrada con id: {encuesta_actualizada.id_encuesta}")
-            db_enc.titulo = encuesta_actualizada.titulo
-            db_enc.descripcion = encuesta_actualizada.descripcion
-            safe_commit(db)
-            db.refresh(db_enc)
-            return Encuesta(id_encuesta=db_enc.id_encuesta, titulo=db_enc.titulo, descripcion=db_enc.descripcion, fecha_creacion=str(db_enc.fecha_creacion))
-        finally:
-            if close_after:
-                db.close()
+            _registrar_cambios(db, 'encuesta', 'actualizar', [db_enc.id_encuesta])
+            return db_enc
+
+        resultado = EncuestaService._escribir(ctx, aplicar, _a_encuesta)
+        _invalidar_cache('encuesta', encuesta_actualizada.id_encuesta)
+        return resultado
 
     @rpc(Integer, _returns=Boolean, _body_style='wrapped')
     def eliminar_encuesta(ctx, id_encuesta: Integer):
+        """Elimina la encuesta con sus preguntas y respuestas en una sola transacción."""
+        def aplicar(db):
+            if db.query(EncuestaDB.id_encuesta).filter(EncuestaDB.id_encuesta == id_encuesta).first() is None:
+                raise ValueError(f"Encuesta no encontrada con id: {id_encuesta}")
+            return borrar_encuesta_en_cascada(db, id_encuesta)
+
+        ids_preguntas = EncuestaService._escribir(ctx, aplicar)
+        _invalidar_cache('encuesta', id_encuesta)
+        _invalidar_cache('pregunta', *ids_preguntas)
+        return True
+
+    @rpc(Integer, Integer, _returns=EstadoPurga, _body_style='wrapped')
+    def purgar_encuesta(ctx, id_encuesta: Integer, tamano_lote: Integer):
+        """Elimina en segundo plano una encuesta grande, borrando sus respuestas en
+        lotes de `tamano_lote`. El progreso se consulta con `obtener_estado_purga`."""
         db, close_after = EncuestaService._get_db(ctx)
         try:
-            db_enc = db.query(EncuestaDB).filter(EncuestaDB.id_encuesta == id_encuesta).first()
-            if db_enc is None:
+            if db.query(EncuestaDB.id_encuesta).filter(EncuestaDB.id_encuesta == id_encuesta).first() is None:
                 raise ValueError(f"Encuesta no encontrada con id: {id_encuesta}")
-            db.delete(db_enc)
-            safe_commit(db)
-            return True
+        finally:
+            if close_after:
+                db.close()
+        return _a_estado_purga(estado_purga(iniciar_purga_encuesta(id_encuesta, tamano_lote)))
+
+    @rpc(Unicode, _returns=EstadoPurga, _body_style='wrapped')
+    def obtener_estado_purga(ctx, id_tarea: Unicode):
+        tarea = estado_purga(id_tarea)
+        if tarea is None:
+            raise ValueError(f"Tarea de purga no encontrada con id: {id_tarea}")
+        return _a_estado_purga(tarea)
+
+    @rpc(Integer, Integer, _returns=Array(Encuesta), _body_style='wrapped')
+    def listar_encuestas(ctx, despues_de: Integer, limite: Integer):
+        """Lista encuestas paginadas por `id_encuesta` (ver `_pagina`)."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_paginar(select(EncuestaDB), EncuestaDB.id_encuesta, despues_de, limite))
+            return [_a_encuesta(db_enc) for db_enc in filas]
         finally:
             if close_after:
                 db.close()
@@ -257,62 +2190,75 @@ class EncuestaService(ServiceBase):
     # --- Preguntas ---
     @rpc(Pregunta, _returns=Pregunta, _body_style='wrapped')
     def crear_pregunta(ctx, pregunta: Pregunta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not pregunta.texto_pregunta or not pregunta.id_encuesta:
-                raise ValueError("'texto_pregunta' e 'id_encuesta' son obligatorios")
-            # validar existencia de encuesta
-            if db.query(EncuestaDB).filter(EncuestaDB.id_encuesta == pregunta.id_encuesta).first() is None:
-                raise ValueError(f"Encuesta no encontrada con id: {pregunta.id_encuesta}")
+        if not pregunta.texto_pregunta or not pregunta.id_encuesta:
+            raise ValueError("'texto_pregunta' e 'id_encuesta' son obligatorios")
+
+        def aplicar(db):
+            # la existencia de la encuesta la comprueba la clave foránea
             db_preg = PreguntaDB(id_encuesta=pregunta.id_encuesta, texto_pregunta=pregunta.texto_pregunta)
             db.add(db_preg)
-            safe_commit(db)
-            db.refresh(db_preg)
-            return Pregunta(id_pregunta=db_preg.id_pregunta, id_encuesta=db_preg.id_encuesta, texto_pregunta=db_preg.texto_pregunta)
-        finally:
-            if close_after:
-                db.close()
+            db.flush()
+            _registrar_cambios(db, 'pregunta', 'crear', [db_preg.id_pregunta])
+            return db_preg
+
+        diagnosticar = _verificar_referencias(
+            (EncuestaDB.id_encuesta, pregunta.id_encuesta, f"Encuesta no encontrada con id: {pregunta.id_encuesta}"))
+        return EncuestaService._escribir(ctx, aplicar, _a_pregunta, diagnosticar)
 
     @rpc(Integer, _returns=Pregunta, _body_style='wrapped')
     def obtener_pregunta(ctx, id_pregunta: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
+        def cargar(db):
             db_preg = db.query(PreguntaDB).filter(PreguntaDB.id_pregunta == id_pregunta).first()
             if db_preg is None:
                 raise ValueError(f"Pregunta no encontrada con id: {id_pregunta}")
-            return Pregunta(id_pregunta=db_preg.id_pregunta, id_encuesta=db_preg.id_encuesta, texto_pregunta=db_preg.texto_pregunta)
-        finally:
-            if close_after:
-                db.close()
+            return _a_pregunta(db_preg)
+
+        return _obtener_cacheado(ctx, 'pregunta', id_pregunta, Pregunta, cargar)
 
     @rpc(Pregunta, _returns=Pregunta, _body_style='wrapped')
     def actualizar_pregunta(ctx, pregunta_actualizada: Pregunta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not pregunta_actualizada.id_pregunta:
-                raise ValueError("'id_pregunta' es requerido para actualizar")
-            db_preg = db.query(PreguntaDB).filter(PreguntaDB.id_pregunta == pregunta_actualizada.id_pregunta).first()
+        if not pregunta_actualizada.id_pregunta:
+            raise ValueError("'id_pregunta' es requerido para actualizar")
+
+        def aplicar(db):
+            db_preg = _actualizar_devolviendo(db, PreguntaDB, PreguntaDB.id_pregunta, pregunta_actualizada.id_pregunta,
+                                              {'texto_pregunta': pregunta_actualizada.texto_pregunta,
+                                               'id_encuesta': pregunta_actualizada.id_encuesta})
             if db_preg is None:
                 raise ValueError(f"Pregunta no encontrada con id: {pregunta_actualizada.id_pregunta}")
-            db_preg.texto_pregunta = pregunta_actualizada.texto_pregunta
-            db_preg.id_encuesta = pregunta_actualizada.id_encuesta
-            safe_commit(db)
-            db.refresh(db_preg)
-            return Pregunta(id_pregunta=db_preg.id_pregunta, id_encuesta=db_preg.id_encuesta, texto_pregunta=db_preg.texto_pregunta)
-        finally:
-            if close_after:
-                db.close()
+            _registrar_cambios(db, 'pregunta', 'actualizar', [db_preg.id_pregunta])
+            return db_preg
+
+        diagnosticar = _verificar_referencias(
+            (EncuestaDB.id_encuesta, pregunta_actualizada.id_encuesta,
+             f"Encuesta no encontrada con id: {pregunta_actualizada.id_encuesta}"))
+        resultado = EncuestaService._escribir(ctx, aplicar, _a_pregunta, diagnosticar)
+        _invalidar_cache('pregunta', pregunta_actualizada.id_pregunta)
+        return resultado
 
     @rpc(Integer, _returns=Boolean, _body_style='wrapped')
     def eliminar_pregunta(ctx, id_pregunta: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            db_preg = db.query(PreguntaDB).filter(PreguntaDB.id_pregunta == id_pregunta).first()
-            if db_preg is None:
+        """Elimina la pregunta junto con sus respuestas."""
+        def aplicar(db):
+            if db.query(PreguntaDB.id_pregunta).filter(PreguntaDB.id_pregunta == id_pregunta).first() is None:
                 raise ValueError(f"Pregunta no encontrada con id: {id_pregunta}")
-            db.delete(db_preg)
-            safe_commit(db)
+            _borrar_respuestas_de_preguntas(db, [id_pregunta])
+            db.execute(delete(PreguntaDB).where(PreguntaDB.id_pregunta == id_pregunta),
+                       execution_options={'synchronize_session': False})
+            _registrar_cambios(db, 'pregunta', 'eliminar', [id_pregunta])
             return True
+
+        resultado = EncuestaService._escribir(ctx, aplicar)
+        _invalidar_cache('pregunta', id_pregunta)
+        return resultado
+
+    @rpc(Integer, Integer, Integer, _returns=Array(Pregunta), _body_style='wrapped')
+    def listar_preguntas_por_encuesta(ctx, id_encuesta: Integer, despues_de: Integer, limite: Integer):
+        """Lista las preguntas de una encuesta paginadas por `id_pregunta`."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_consulta_preguntas_por_encuesta(id_encuesta, despues_de, limite))
+            return [_a_pregunta(db_preg) for db_preg in filas]
         finally:
             if close_after:
                 db.close()
@@ -320,156 +2266,1036 @@ class EncuestaService(ServiceBase):
     # --- Usuarios ---
     @rpc(Usuario, _returns=Usuario, _body_style='wrapped')
     def crear_usuario(ctx, usuario: Usuario):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not usuario.nombre:
-                raise ValueError("'nombre' es obligatorio para crear un usuario")
+        if not usuario.nombre:
+            raise ValueError("'nombre' es obligatorio para crear un usuario")
+
+        def aplicar(db):
             db_usr = UsuarioDB(nombre=usuario.nombre, apellidos=usuario.apellidos, email=usuario.email, telefono=usuario.telefono, genero=usuario.genero)
             db.add(db_usr)
-            safe_commit(db)
-            db.refresh(db_usr)
-            return Usuario(id_usuario=db_usr.id_usuario, nombre=db_usr.nombre, apellidos=db_usr.apellidos, email=db_usr.email, telefono=db_usr.telefono, genero=db_usr.genero)
-        finally:
-            if close_after:
-                db.close()
+            db.flush()
+            _registrar_cambios(db, 'usuario', 'crear', [db_usr.id_usuario])
+            return db_usr
+
+        return EncuestaService._escribir(ctx, aplicar, _a_usuario)
 
     @rpc(Integer, _returns=Usuario, _body_style='wrapped')
     def obtener_usuario(ctx, id_usuario: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
+        def cargar(db):
             db_usr = db.query(UsuarioDB).filter(UsuarioDB.id_usuario == id_usuario).first()
             if db_usr is None:
                 raise ValueError(f"Usuario no encontrado con id: {id_usuario}")
-            return Usuario(id_usuario=db_usr.id_usuario, nombre=db_usr.nombre, apellidos=db_usr.apellidos, email=db_usr.email, telefono=db_usr.telefono, genero=db_usr.genero)
-        finally:
-            if close_after:
-                db.close()
+            return _a_usuario(db_usr)
+
+        return _obtener_cacheado(ctx, 'usuario', id_usuario, Usuario, cargar)
 
     @rpc(Usuario, _returns=Usuario, _body_style='wrapped')
     def actualizar_usuario(ctx, usuario_actualizado: Usuario):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not usuario_actualizado.id_usuario:
-                raise ValueError("'id_usuario' es requerido para actualizar")
-            db_usr = db.query(UsuarioDB).filter(UsuarioDB.id_usuario == usuario_actualizado.id_usuario).first()
+        if not usuario_actualizado.id_usuario:
+            raise ValueError("'id_usuario' es requerido para actualizar")
+
+        def aplicar(db):
+            db_usr = _actualizar_devolviendo(db, UsuarioDB, UsuarioDB.id_usuario, usuario_actualizado.id_usuario,
+                                             {'nombre': usuario_actualizado.nombre,
+                                              'apellidos': usuario_actualizado.apellidos,
+                                              'email': usuario_actualizado.email,
+                                              'telefono': usuario_actualizado.telefono,
+                                              'genero': usuario_actualizado.genero})
             if db_usr is None:
                 raise ValueError(f"Usuario no encontrado con id: {usuario_actualizado.id_usuario}")
-            db_usr.nombre = usuario_actualizado.nombre
-            db_usr.apellidos = usuario_actualizado.apellidos
-            db_usr.email = usuario_actualizado.email
-            db_usr.telefono = usuario_actualizado.telefono
-            db_usr.genero = usuario_actualizado.genero
-            safe_commit(db)
-            db.refresh(db_usr)
-            return Usuario(id_usuario=db_usr.id_usuario, nombre=db_usr.nombre, apellidos=db_usr.apellidos, email=db_usr.email, telefono=db_usr.telefono, genero=db_usr.genero)
-        finally:
-            if close_after:
-                db.close()
+            _registrar_cambios(db, 'usuario', 'actualizar', [db_usr.id_usuario])
+            return db_usr
+
+        resultado = EncuestaService._escribir(ctx, aplicar, _a_usuario)
+        _invalidar_cache('usuario', usuario_actualizado.id_usuario)
+        return resultado
 
     @rpc(Integer, _returns=Boolean, _body_style='wrapped')
     def eliminar_usuario(ctx, id_usuario: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            db_usr = db.query(UsuarioDB).filter(UsuarioDB.id_usuario == id_usuario).first()
-            if db_usr is None:
+        """Elimina el usuario junto con sus respuestas."""
+        def aplicar(db):
+            if db.query(UsuarioDB.id_usuario).filter(UsuarioDB.id_usuario == id_usuario).first() is None:
                 raise ValueError(f"Usuario no encontrado con id: {id_usuario}")
-            db.delete(db_usr)
-            safe_commit(db)
+            borrar_respuestas_de_usuario(db, id_usuario)
+            db.execute(delete(UsuarioDB).where(UsuarioDB.id_usuario == id_usuario),
+                       execution_options={'synchronize_session': False})
+            _registrar_cambios(db, 'usuario', 'eliminar', [id_usuario])
             return True
+
+        resultado = EncuestaService._escribir(ctx, aplicar)
+        _invalidar_cache('usuario', id_usuario)
+        return resultado
+
+    @rpc(Integer, Integer, _returns=Array(Usuario), _body_style='wrapped')
+    def listar_usuarios(ctx, despues_de: Integer, limite: Integer):
+        """Lista usuarios paginados por `id_usuario`."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_paginar(select(UsuarioDB), UsuarioDB.id_usuario, despues_de, limite))
+            return [_a_usuario(db_usr) for db_usr in filas]
         finally:
             if close_after:
                 db.close()
 
+    # --- Búsqueda ---
+    @rpc(Unicode, Integer, Integer, Integer, _returns=Array(Respuesta), _body_style='wrapped')
+    def buscar_respuestas(ctx, texto: Unicode, id_encuesta: Integer, desplazamiento: Integer, limite: Integer):
+        """Respuestas que contienen todas las palabras de `texto` (sin distinguir
+        mayúsculas ni acentos), de la más a la menos relevante. `id_encuesta` es
+        opcional; se pagina con `desplazamiento` y `limite`."""
+        return EncuestaService._buscar(ctx, 'respuesta', texto, id_encuesta, desplazamiento, limite, _a_respuesta)
+
+    @rpc(Unicode, Integer, Integer, Integer, _returns=Array(Pregunta), _body_style='wrapped')
+    def buscar_preguntas(ctx, texto: Unicode, id_encuesta: Integer, desplazamiento: Integer, limite: Integer):
+        """Preguntas que contienen todas las palabras de `texto` (ver `buscar_respuestas`)."""
+        return EncuestaService._buscar(ctx, 'pregunta', texto, id_encuesta, desplazamiento, limite, _a_pregunta)
+
+    @staticmethod
+    def _buscar(ctx, entidad, texto, id_encuesta, desplazamiento, limite, convertir):
+        if not texto or not texto.strip():
+            raise ValueError("'texto' es obligatorio para buscar")
+        if desplazamiento and desplazamiento < 0:
+            raise ValueError("'desplazamiento' no puede ser negativo")
+        indice_busqueda.asegurar(obtener_engine())
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = indice_busqueda.buscar(db, entidad, texto, id_encuesta, desplazamiento, _limite_pagina(limite))
+            return [convertir(fila) for fila in filas]
+        finally:
+            if close_after:
+                db.close()
+
+    # --- Cambios ---
+    @rpc(Integer, Integer, _returns=Array(Cambio), _body_style='wrapped')
+    def obtener_cambios_desde(ctx, cursor: Integer, limite: Integer):
+        """Cambios registrados después de `cursor`, en orden de `id_cambio`.
+
+        El cliente guarda el último `id_cambio` recibido y lo envía como `cursor`
+        en la siguiente llamada (vacío o 0 para empezar); una página con menos de
+        `limite` cambios indica que está al día. Solo trae ids de entidades: el
+        cliente vuelve a pedir las creadas/actualizadas y descarta las eliminadas.
+        Los cambios de los últimos CAMBIOS_MARGEN_SEGUNDOS llegan en una llamada
+        posterior (ver `_cambios_asentados`).
+        """
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = _cambios_asentados(db, db.scalars(_consulta_cambios_desde(cursor, limite)).all())
+            return [_a_cambio(db_cambio) for db_cambio in filas]
+        finally:
+            if close_after:
+                db.close()
+
+    # --- Caché ---
+    @rpc(_returns=EstadisticasCache, _body_style='wrapped')
+    def obtener_estadisticas_cache(ctx):
+        """Contadores de la caché de entidades para dimensionarla."""
+        cache_entidades = obtener_cache()
+        if cache_entidades is None:
+            return EstadisticasCache(backend='ninguna', entradas=0, aciertos=0, fallos=0, desalojos=0)
+        return EstadisticasCache(backend=cache_entidades.nombre, entradas=len(cache_entidades),
+                                 aciertos=cache_entidades.aciertos, fallos=cache_entidades.fallos,
+                                 desalojos=cache_entidades.desalojos)
+
     # --- Respuestas ---
     @rpc(Respuesta, _returns=Respuesta, _body_style='wrapped')
     def crear_respuesta(ctx, respuesta: Respuesta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not respuesta.texto_respuesta or not respuesta.id_pregunta:
-                raise ValueError("'texto_respuesta' e 'id_pregunta' son obligatorios")
-            if db.query(PreguntaDB).filter(PreguntaDB.id_pregunta == respuesta.id_pregunta).first() is None:
-                raise ValueError(f"Pregunta no encontrada con id: {respuesta.id_pregunta}")
-            # usuario opcional
+        if not respuesta.texto_respuesta or not respuesta.id_pregunta:
+            raise ValueError("'texto_respuesta' e 'id_pregunta' son obligatorios")
+
+        if spool_respuestas is not None:
+            # Modo diferido: se confirma en cuanto está en el spool, con un id
+            # provisional negativo (ver obtener_respuesta_diferida)
+            maximo = RespuestaDB.texto_respuesta.type.length
+            if len(respuesta.texto_respuesta) > maximo:
+                raise ValueError(f"'texto_respuesta' no puede superar {maximo} caracteres")
+            id_provisional, fecha = spool_respuestas.aceptar(respuesta.id_pregunta, respuesta.id_usuario,
+                                                              respuesta.texto_respuesta)
+            return Respuesta(id_respuesta=-id_provisional, id_pregunta=respuesta.id_pregunta,
+                             id_usuario=respuesta.id_usuario, texto_respuesta=respuesta.texto_respuesta,
+                             fecha_registro=str(fecha))
+
+        def aplicar(db):
+            # pregunta y usuario (opcional) los comprueban las claves foráneas
             db_res = RespuestaDB(id_pregunta=respuesta.id_pregunta, id_usuario=respuesta.id_usuario, texto_respuesta=respuesta.texto_respuesta)
             db.add(db_res)
-            safe_commit(db)
-            db.refresh(db_res)
-            return Respuesta(id_respuesta=db_res.id_respuesta, id_pregunta=db_res.id_pregunta, id_usuario=db_res.id_usuario, texto_respuesta=db_res.texto_respuesta, fecha_registro=str(db_res.fecha_registro))
-        finally:
-            if close_after:
-                db.close()
+            db.flush()
+            _ajustar_conteos(db, {(db_res.id_pregunta, db_res.texto_respuesta): 1})
+            _registrar_cambios(db, 'respuesta', 'crear', [db_res.id_respuesta])
+            return db_res
+
+        diagnosticar = _verificar_referencias(
+            (PreguntaDB.id_pregunta, respuesta.id_pregunta, f"Pregunta no encontrada con id: {respuesta.id_pregunta}"),
+            (UsuarioDB.id_usuario, respuesta.id_usuario, f"Usuario no encontrado con id: {respuesta.id_usuario}"))
+        return EncuestaService._escribir(ctx, aplicar, _a_respuesta, diagnosticar)
+
+    @rpc(Integer, _returns=EstadoRespuestaDiferida, _body_style='wrapped')
+    def obtener_respuesta_diferida(ctx, id_provisional: Integer):
+        """Estado de una respuesta aceptada en modo diferido; admite el id
+        provisional tal como lo devolvió crear_respuesta (negativo)."""
+        if spool_respuestas is None:
+            raise ValueError("El modo de respuestas diferidas no está activo (RESPUESTAS_DIFERIDAS)")
+        estado = spool_respuestas.estado(abs(id_provisional or 0))
+        if estado is None:
+            raise ValueError(f"Respuesta diferida no encontrada con id: {id_provisional}")
+        return EstadoRespuestaDiferida(**estado)
+
+    @rpc(Array(Respuesta), _returns=Array(ResultadoLote), _body_style='wrapped', _out_variable_name='resultados')
+    def crear_respuestas_lote(ctx, respuestas):
+        """Crea varias respuestas en una sola transacción. Los elementos inválidos
+        se reportan individualmente y no impiden insertar el resto."""
+        respuestas = list(respuestas or [])
+        if not respuestas:
+            raise ValueError("Se requiere al menos una respuesta en el lote")
+        if len(respuestas) > LOTE_MAX_RESPUESTAS:
+            raise ValueError(f"El lote excede el máximo de {LOTE_MAX_RESPUESTAS} respuestas")
+
+        def aplicar(db):
+            ids_preguntas = {r.id_pregunta for r in respuestas if r is not None and r.id_pregunta}
+            ids_usuarios = {r.id_usuario for r in respuestas if r is not None and r.id_usuario}
+            preguntas, usuarios = _ids_existentes(db, ids_preguntas, ids_usuarios)
+
+            resultados = [None] * len(respuestas)
+            validas = []
+            for indice, respuesta in enumerate(respuestas):
+                if respuesta is None or not respuesta.texto_respuesta or not respuesta.id_pregunta:
+                    error = "'texto_respuesta' e 'id_pregunta' son obligatorios"
+                elif respuesta.id_pregunta not in preguntas:
+                    error = f"Pregunta no encontrada con id: {respuesta.id_pregunta}"
+                elif respuesta.id_usuario and respuesta.id_usuario not in usuarios:
+                    error = f"Usuario no encontrado con id: {respuesta.id_usuario}"
+                else:
+                    validas.append((indice, {'id_pregunta': respuesta.id_pregunta, 'id_usuario': respuesta.id_usuario,
+                                             'texto_respuesta': respuesta.texto_respuesta}))
+                    continue
+                resultados[indice] = ResultadoLote(indice=indice, exito=False, error=error)
+
+            if validas:
+                filas = [fila for _, fila in validas]
+                ids = _insertar_respuestas(db, filas)
+                _ajustar_conteos(db, Counter((fila['id_pregunta'], fila['texto_respuesta']) for fila in filas))
+                _registrar_cambios(db, 'respuesta', 'crear', ids)
+                for (indice, _), id_respuesta in zip(validas, ids):
+                    resultados[indice] = ResultadoLote(indice=indice, id_respuesta=id_respuesta, exito=True)
+            return resultados
+
+        return EncuestaService._escribir(ctx, aplicar)
 
     @rpc(Integer, _returns=Respuesta, _body_style='wrapped')
     def obtener_respuesta(ctx, id_respuesta: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
         try:
             db_res = db.query(RespuestaDB).filter(RespuestaDB.id_respuesta == id_respuesta).first()
             if db_res is None:
                 raise ValueError(f"Respuesta no encontrada con id: {id_respuesta}")
-            return Respuesta(id_respuesta=db_res.id_respuesta, id_pregunta=db_res.id_pregunta, id_usuario=db_res.id_usuario, texto_respuesta=db_res.texto_respuesta, fecha_registro=str(db_res.fecha_registro))
+            return _a_respuesta(db_res)
         finally:
             if close_after:
                 db.close()
 
     @rpc(Respuesta, _returns=Respuesta, _body_style='wrapped')
     def actualizar_respuesta(ctx, respuesta_actualizada: Respuesta):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
-            if not respuesta_actualizada.id_respuesta:
-                raise ValueError("'id_respuesta' es requerido para actualizar")
+        if not respuesta_actualizada.id_respuesta:
+            raise ValueError("'id_respuesta' es requerido para actualizar")
+
+        def aplicar(db):
             db_res = db.query(RespuestaDB).filter(RespuestaDB.id_respuesta == respuesta_actualizada.id_respuesta).first()
             if db_res is None:
                 raise ValueError(f"Respuesta no encontrada con id: {respuesta_actualizada.id_respuesta}")
+            if db_res.texto_respuesta != respuesta_actualizada.texto_respuesta:
+                _ajustar_conteos(db, {(db_res.id_pregunta, db_res.texto_respuesta): -1,
+                                      (db_res.id_pregunta, respuesta_actualizada.texto_respuesta): 1})
             db_res.texto_respuesta = respuesta_actualizada.texto_respuesta
             db_res.id_usuario = respuesta_actualizada.id_usuario
-            safe_commit(db)
-            db.refresh(db_res)
-            return Respuesta(id_respuesta=db_res.id_respuesta, id_pregunta=db_res.id_pregunta, id_usuario=db_res.id_usuario, texto_respuesta=db_res.texto_respuesta, fecha_registro=str(db_res.fecha_registro))
-        finally:
-            if close_after:
-                db.close()
+            _registrar_cambios(db, 'respuesta', 'actualizar', [db_res.id_respuesta])
+            return db_res
+
+        diagnosticar = _verificar_referencias(
+            (UsuarioDB.id_usuario, respuesta_actualizada.id_usuario,
+             f"Usuario no encontrado con id: {respuesta_actualizada.id_usuario}"))
+        return EncuestaService._escribir(ctx, aplicar, _a_respuesta, diagnosticar)
 
     @rpc(Integer, _returns=Boolean, _body_style='wrapped')
     def eliminar_respuesta(ctx, id_respuesta: Integer):
-        db, close_after = EncuestaService._get_db(ctx)
-        try:
+        def aplicar(db):
             db_res = db.query(RespuestaDB).filter(RespuestaDB.id_respuesta == id_respuesta).first()
             if db_res is None:
                 raise ValueError(f"Respuesta no encontrada con id: {id_respuesta}")
+            _ajustar_conteos(db, {(db_res.id_pregunta, db_res.texto_respuesta): -1})
             db.delete(db_res)
-            safe_commit(db)
+            _registrar_cambios(db, 'respuesta', 'eliminar', [id_respuesta])
             return True
+
+        return EncuestaService._escribir(ctx, aplicar)
+
+    @rpc(Integer, Integer, Integer, _returns=Array(Respuesta), _body_style='wrapped')
+    def listar_respuestas_por_pregunta(ctx, id_pregunta: Integer, despues_de: Integer, limite: Integer):
+        """Lista las respuestas de una pregunta paginadas por `id_respuesta`."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_consulta_respuestas_por_pregunta(id_pregunta, despues_de, limite))
+            return [_a_respuesta(db_res) for db_res in filas]
+        finally:
+            if close_after:
+                db.close()
+
+    @rpc(Integer, Integer, Integer, _returns=Array(Respuesta), _body_style='wrapped')
+    def listar_respuestas_por_encuesta(ctx, id_encuesta: Integer, despues_de: Integer, limite: Integer):
+        """Lista las respuestas de todas las preguntas de una encuesta paginadas por `id_respuesta`."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_consulta_respuestas_por_encuesta(id_encuesta, despues_de, limite))
+            return [_a_respuesta(db_res) for db_res in filas]
+        finally:
+            if close_after:
+                db.close()
+
+    @rpc(Integer, Integer, Integer, _returns=Array(Respuesta), _body_style='wrapped')
+    def listar_respuestas_por_usuario(ctx, id_usuario: Integer, despues_de: Integer, limite: Integer):
+        """Lista las respuestas de un usuario paginadas por `id_respuesta`."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.scalars(_consulta_respuestas_por_usuario(id_usuario, despues_de, limite))
+            return [_a_respuesta(db_res) for db_res in filas]
+        finally:
+            if close_after:
+                db.close()
+
+    @rpc(Integer, _returns=Array(ResultadoPregunta), _body_style='wrapped')
+    def obtener_resultados_encuesta(ctx, id_encuesta: Integer):
+        """Cuántas personas dieron cada respuesta a cada pregunta de la encuesta,
+        leído de los conteos agregados (no recorre `answers`)."""
+        db, close_after = EncuestaService._get_db(ctx, solo_lectura=True)
+        try:
+            filas = db.execute(_consulta_resultados_encuesta(id_encuesta)).all()
+            return [ResultadoPregunta(id_pregunta=id_pregunta, texto_pregunta=texto_pregunta,
+                                      texto_respuesta=texto_respuesta, total=total)
+                    for id_pregunta, texto_pregunta, texto_respuesta, total in filas]
         finally:
             if close_after:
                 db.close()
 
 
-# --- 5. Creación de la Aplicación y Servidor ---
+# --- 9. Métricas ---
+
+# Latencia por operación (histograma), bytes de petición/respuesta, Faults y
+# número de sentencias SQL / tiempo en BD por petición. Se sirven en texto
+# (formato Prometheus) en /metrics. Cada proceso trabajador tiene sus propios
+# contadores. Las sentencias ejecutadas por el escritor agrupado (otro hilo)
+# no se atribuyen a la petición.
+#   METRICAS_UMBRAL_LENTO_MS: registra en el log las peticiones más lentas que
+#                             este umbral (0 = desactivado).
+METRICAS_UMBRAL_LENTO_MS = float(os.getenv('METRICAS_UMBRAL_LENTO_MS', '0'))
+METRICAS_CUBETAS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Contador de SQL de la petición en curso (None fuera de una petición)
+_sql_peticion = contextvars.ContextVar('sql_peticion', default=None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _antes_de_sql(conn, cursor, statement, parameters, context, executemany):
+    if _sql_peticion.get() is not None:
+        conn.info.setdefault('inicio_sql', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _despues_de_sql(conn, cursor, statement, parameters, context, executemany):
+    contador = _sql_peticion.get()
+    if contador is not None and conn.info.get('inicio_sql'):
+        contador['sentencias'] += 1
+        contador['tiempo'] += time.perf_counter() - conn.info['inicio_sql'].pop()
+
+
+class Metricas:
+    """Acumula métricas por operación y protocolo; seguro entre hilos."""
+
+    def __init__(self, cubetas=METRICAS_CUBETAS):
+        self.cubetas = cubetas
+        self._lock = threading.Lock()
+        self._operaciones = {}
+
+    def registrar(self, operacion, segundos, bytes_peticion, bytes_respuesta, error, sentencias, tiempo_sql,
+                  protocolo='soap'):
+        with self._lock:
+            clave = (operacion, protocolo)
+            datos = self._operaciones.get(clave)
+            if datos is None:
+                datos = self._operaciones[clave] = {
+                    'cubetas': [0] * len(self.cubetas), 'total': 0, 'suma': 0.0, 'errores': 0,
+                    'bytes_peticion': 0, 'bytes_respuesta': 0, 'sentencias': 0, 'tiempo_sql': 0.0}
+            for i, limite in enumerate(self.cubetas):
+                if segundos <= limite:
+                    datos['cubetas'][i] += 1
+            datos['total'] += 1
+            datos['suma'] += segundos
+            datos['errores'] += 1 if error else 0
+            datos['bytes_peticion'] += bytes_peticion
+            datos['bytes_respuesta'] += bytes_respuesta
+            datos['sentencias'] += sentencias
+            datos['tiempo_sql'] += tiempo_sql
+
+    def texto(self):
+        """Exporta las métricas en el formato de texto de Prometheus."""
+        with self._lock:
+            operaciones = {clave: dict(datos, cubetas=list(datos['cubetas'])) for clave, datos in self._operaciones.items()}
+        lineas = ['# TYPE encuestas_latencia_segundos histogram']
+        for (op, protocolo), datos in sorted(operaciones.items()):
+            etiquetas = f'operacion="{op}",protocolo="{protocolo}"'
+            for limite, cantidad in zip(self.cubetas, datos['cubetas']):
+                lineas.append(f'encuestas_latencia_segundos_bucket{{{etiquetas},le="{limite}"}} {cantidad}')
+            lineas.append(f'encuestas_latencia_segundos_bucket{{{etiquetas},le="+Inf"}} {datos["total"]}')
+            lineas.append(f'encuestas_latencia_segundos_sum{{{etiquetas}}} {datos["suma"]:.6f}')
+            lineas.append(f'encuestas_latencia_segundos_count{{{etiquetas}}} {datos["total"]}')
+        for nombre, campo, tipo in (('encuestas_faults_total', 'errores', 'counter'),
+                                    ('encuestas_peticion_bytes_total', 'bytes_peticion', 'counter'),
+                                    ('encuestas_respuesta_bytes_total', 'bytes_respuesta', 'counter'),
+                                    ('encuestas_sql_sentencias_total', 'sentencias', 'counter'),
+                                    ('encuestas_sql_segundos_total', 'tiempo_sql', 'counter')):
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            for (op, protocolo), datos in sorted(operaciones.items()):
+                valor = datos[campo]
+                etiquetas = f'operacion="{op}",protocolo="{protocolo}"'
+                lineas.append(f'{nombre}{{{etiquetas}}} {valor:.6f}' if isinstance(valor, float)
+                              else f'{nombre}{{{etiquetas}}} {valor}')
+        # Solo si la caché ya existe: /metrics no debe crearla
+        cache_entidades = _cache_entidades
+        if cache_entidades is not None:
+            for campo in ('aciertos', 'fallos', 'desalojos'):
+                lineas.append(f'# TYPE encuestas_cache_{campo}_total counter')
+                lineas.append(f'encuestas_cache_{campo}_total {getattr(cache_entidades, campo)}')
+            lineas.append('# TYPE encuestas_cache_entradas gauge')
+            lineas.append(f'encuestas_cache_entradas {len(cache_entidades)}')
+        if spool_respuestas is not None:
+            for campo in ('persistidas', 'rechazadas', 'reintentos'):
+                lineas.append(f'# TYPE encuestas_spool_{campo}_total counter')
+                lineas.append(f'encuestas_spool_{campo}_total {getattr(spool_respuestas, campo)}')
+            lineas.append('# TYPE encuestas_spool_pendientes gauge')
+            lineas.append(f'encuestas_spool_pendientes {spool_respuestas.pendientes()}')
+        return '\n'.join(lineas) + '\n'
+
+
+metricas = Metricas()
+
+
+def _al_llamar_metodo(ctx):
+    env = ctx.transport.req_env
+    env['encuestas.operacion'] = ctx.method_name
+    env['encuestas.sql'] = {'sentencias': 0, 'tiempo': 0.0}
+    env['encuestas.sql_token'] = _sql_peticion.set(env['encuestas.sql'])
+
+
+def _al_terminar_metodo(ctx):
+    env = ctx.transport.req_env
+    token = env.pop('encuestas.sql_token', None)
+    if token is not None:
+        _sql_peticion.reset(token)
+
+
+def _al_fallar_metodo(ctx):
+    ctx.transport.req_env['encuestas.fault'] = True
+    _al_terminar_metodo(ctx)
+
+
+EncuestaService.event_manager.add_listener('method_call', _al_llamar_metodo)
+EncuestaService.event_manager.add_listener('method_return_object', _al_terminar_metodo)
+EncuestaService.event_manager.add_listener('method_exception_object', _al_fallar_metodo)
+
+
+class _RespuestaMedida:
+    """Iterable que cuenta los bytes de la respuesta y registra las métricas al cerrarse."""
+
+    def __init__(self, iterable, environ, inicio, estado, protocolo):
+        self._iterable = iterable
+        self._environ = environ
+        self._inicio = inicio
+        self._estado = estado
+        self._protocolo = protocolo
+        self._bytes = 0
+
+    def __iter__(self):
+        for bloque in self._iterable:
+            self._bytes += len(bloque)
+            yield bloque
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._registrar()
+
+    def _registrar(self):
+        env = self._environ
+        token = env.pop('encuestas.sql_token', None)
+        if token is not None:
+            _sql_peticion.reset(token)
+        segundos = time.perf_counter() - self._inicio
+        operacion = env.get('encuestas.operacion')
+        if operacion is None:
+            operacion = 'wsdl' if env.get('QUERY_STRING', '').lower().startswith('wsdl') else 'desconocida'
+        sql = env.get('encuestas.sql') or {'sentencias': 0, 'tiempo': 0.0}
+        error = env.get('encuestas.fault', False) or self._estado[0][:1] in ('4', '5')
+        try:
+            bytes_peticion = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            bytes_peticion = 0
+        metricas.registrar(operacion, segundos, bytes_peticion, self._bytes, error, sql['sentencias'], sql['tiempo'],
+                           self._protocolo)
+        if METRICAS_UMBRAL_LENTO_MS and segundos * 1000 >= METRICAS_UMBRAL_LENTO_MS:
+            logging.warning(f"Petición lenta: {operacion} ({self._protocolo}) tardó {segundos * 1000:.1f} ms "
+                            f"({sql['sentencias']} sentencias SQL, {sql['tiempo'] * 1000:.1f} ms en BD)")
+
+
+def con_metricas(app, protocolo='soap'):
+    """Middleware WSGI que mide cada petición a `app` (etiquetada con `protocolo`)."""
+    def aplicacion(environ, start_response):
+        inicio = time.perf_counter()
+        estado = ['']
+
+        def start_response_medido(status, headers, exc_info=None):
+            estado[0] = status
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+        respuesta = app(environ, start_response_medido)
+        return _RespuestaMedida(respuesta, environ, inicio, estado, protocolo)
+    return aplicacion
+
+
+def metricas_wsgi(environ, start_response):
+    cuerpo = metricas.texto().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                              ('Content-Length', str(len(cuerpo)))])
+    return [cuerpo]
+
+
+# --- 10. Exportación masiva de respuestas ---
+
+# Volcado de `answers` unido a preguntas, encuestas y usuarios, leído con un
+# cursor del lado del servidor en bloques de EXPORTAR_BLOQUE filas y escrito
+# de forma incremental: la memoria no depende del tamaño de la tabla.
+EXPORTAR_BLOQUE = int(os.getenv('EXPORTAR_BLOQUE', '1000'))
+COLUMNAS_EXPORTACION = ('id_respuesta', 'fecha_registrada', 'texto_respuesta', 'id_pregunta', 'texto_pregunta',
+                        'id_encuesta', 'titulo_encuesta', 'id_usuario', 'nombre', 'apellidos', 'email')
+
+
+def _consulta_exportacion(id_encuesta=None, desde=None, hasta=None):
+    consulta = (select(RespuestaDB.id_respuesta, RespuestaDB.fecha_registro, RespuestaDB.texto_respuesta,
+                       PreguntaDB.id_pregunta, PreguntaDB.texto_pregunta,
+                       EncuestaDB.id_encuesta, EncuestaDB.titulo,
+                       UsuarioDB.id_usuario, UsuarioDB.nombre, UsuarioDB.apellidos, UsuarioDB.email)
+                .join(PreguntaDB, PreguntaDB.id_pregunta == RespuestaDB.id_pregunta)
+                .join(EncuestaDB, EncuestaDB.id_encuesta == PreguntaDB.id_encuesta)
+                .outerjoin(UsuarioDB, UsuarioDB.id_usuario == RespuestaDB.id_usuario))
+    if id_encuesta:
+        consulta = consulta.where(PreguntaDB.id_encuesta == id_encuesta)
+    if desde is not None:
+        consulta = consulta.where(RespuestaDB.fecha_registro >= desde)
+    if hasta is not None:
+        consulta = consulta.where(RespuestaDB.fecha_registro < hasta)
+    return consulta.order_by(RespuestaDB.id_respuesta)
+
+
+def _valor_exportable(valor):
+    return valor.isoformat(sep=' ') if isinstance(valor, datetime) else valor
+
+
+def exportar_respuestas(formato='csv', id_encuesta=None, desde=None, hasta=None, comprimir=False,
+                        bloque=EXPORTAR_BLOQUE):
+    """Generador de bytes con el volcado de respuestas en CSV o NDJSON.
+
+    `desde` es inclusivo y `hasta` exclusivo (sobre `fecha_registrada`).
+    Con `comprimir=True` la salida es un flujo gzip.
+    """
+    if formato not in ('csv', 'ndjson'):
+        raise ValueError(f"Formato de exportación no soportado: {formato}")
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31) if comprimir else None
+
+    def salida(texto):
+        datos = texto.encode('utf-8')
+        return compresor.compress(datos) if compresor is not None else datos
+
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer) if formato == 'csv' else None
+    if escritor is not None:
+        # La cabecera sale antes de ejecutar la consulta: primer byte inmediato
+        escritor.writerow(COLUMNAS_EXPORTACION)
+        cabecera = salida(buffer.getvalue())
+        yield cabecera + compresor.flush(zlib.Z_SYNC_FLUSH) if compresor is not None else cabecera
+        buffer.seek(0)
+        buffer.truncate()
+
+    with enrutador_lecturas.engine_lectura().connect() as conn:
+        resultado = conn.execution_options(stream_results=True, yield_per=bloque).execute(
+            _consulta_exportacion(id_encuesta, desde, hasta))
+        for filas in resultado.partitions(bloque):
+            for fila in filas:
+                valores = [_valor_exportable(v) for v in fila]
+                if escritor is not None:
+                    escritor.writerow(valores)
+                else:
+                    buffer.write(json.dumps(dict(zip(COLUMNAS_EXPORTACION, valores)), ensure_ascii=False))
+                    buffer.write('\n')
+            datos = salida(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            if datos:
+                yield datos
+    if compresor is not None:
+        yield compresor.flush()
+
+
+def _fecha_parametro(valor):
+    return datetime.fromisoformat(valor) if valor else None
+
+
+def exportar_wsgi(environ, start_response):
+    """GET /exportar/respuestas?formato=csv|ndjson&id_encuesta=&desde=&hasta=&gzip=1"""
+    parametros = parse_qs(environ.get('QUERY_STRING', ''))
+
+    def parametro(nombre):
+        return parametros.get(nombre, [None])[0]
 
-# Creamos las tablas en la BD (usando Base, que conoce a PreguntaDB)
-# Comprobación de conexión a la BD y mensaje claro al iniciar
-if _check_db_connection(engine, DATABASE_URL):
     try:
-        Base.metadata.create_all(bind=engine)
+        formato = parametro('formato') or 'csv'
+        if formato not in ('csv', 'ndjson'):
+            raise ValueError(f"Formato de exportación no soportado: {formato}")
+        comprimir = (parametro('gzip') or '').lower() in ('1', 'true', 'si')
+        id_encuesta = int(parametro('id_encuesta')) if parametro('id_encuesta') else None
+        desde, hasta = _fecha_parametro(parametro('desde')), _fecha_parametro(parametro('hasta'))
+    except ValueError as e:
+        cuerpo = str(e).encode('utf-8')
+        start_response('400 Bad Request', [('Content-Type', 'text/plain; charset=utf-8'),
+                                           ('Content-Length', str(len(cuerpo)))])
+        return [cuerpo]
+
+    nombre = f"respuestas{'_' + str(id_encuesta) if id_encuesta else ''}.{formato}"
+    tipo = 'text/csv; charset=utf-8' if formato == 'csv' else 'application/x-ndjson; charset=utf-8'
+    if comprimir:
+        nombre += '.gz'
+        tipo = 'application/gzip'
+    start_response('200 OK', [('Content-Type', tipo),
+                              ('Content-Disposition', f'attachment; filename="{nombre}"')])
+    return exportar_respuestas(formato, id_encuesta, desde, hasta, comprimir)
+
+
+# --- 11. Creación de la Aplicación y Servidor ---
+
+# Importar el módulo no toca la BD ni construye las aplicaciones Spyne: el
+# engine se crea en el primer uso, el esquema solo se crea cuando se pide y las
+# aplicaciones las construye crear_aplicacion() (o el primer acceso a
+# `application`, `wsgi_application`, `aplicacion_wsgi`, ...).
+
+# Creación del esquema (tablas, índices e índice de búsqueda): opcional con
+# ESQUEMA_AUTOCREAR, `servir --crear-esquema` o `python3 app.py crear-esquema`.
+# Por defecto solo se hace al servir con el SQLite local de desarrollo.
+ESQUEMA_AUTOCREAR = os.getenv('ESQUEMA_AUTOCREAR', '0' if os.getenv('DATABASE_URL') else '1').lower() in (
+    '1', 'true', 'si', 'yes')
+
+
+def crear_esquema(bind=None):
+    """Crea las tablas y el índice de búsqueda que falten. Devuelve False si
+    no se pudo conectar a la BD o falló la creación."""
+    bind = bind if bind is not None else obtener_engine()
+    # Comprobación de conexión a la BD y mensaje claro al iniciar
+    if not _check_db_connection(bind, DATABASE_URL):
+        logging.warning("Continuando sin crear tablas (problema de conexión a la BD remota). Revisa DATABASE_URL o usa SQLite local.")
+        return False
+    try:
+        Base.metadata.create_all(bind=bind)
+        indice_busqueda.preparar(bind)
     except Exception:
         logging.exception("Error creando tablas en la base de datos")
-else:
-    logging.warning("Continuando sin crear tablas (problema de conexión a la BD remota). Revisa DATABASE_URL o usa SQLite local.")
+        return False
+    return True
+
+
+# WSDL pregenerado con `python3 app.py generar-wsdl`; si el archivo no existe
+# se genera con la URL de la primera petición ?wsdl.
+WSDL_ARCHIVO = os.getenv('WSDL_ARCHIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'encuestas.wsdl'))
+
+
+class WSDLPrecalculado:
+    """Middleware WSGI que sirve el WSDL (con su XSD) como bytes ya renderizados.
+
+    El documento se genera una sola vez por proceso (o se lee del archivo
+    generado en el build) y se sirve con ETag: un cliente que ya lo tiene
+    recibe 304 sin cuerpo. El resto de peticiones pasan a `wsgi_app`, que
+    enlaza crear_aplicacion().
+    """
+
+    def __init__(self, archivo=None, wsgi_app=None):
+        self.wsgi_app = wsgi_app
+        self.archivo = archivo
+        self._lock = threading.Lock()
+        self.contenido = None
+        self.etag = None
+
+    def _fijar(self, contenido):
+        self.etag = f'"{hashlib.sha256(contenido).hexdigest()[:32]}"'
+        self.contenido = contenido
+
+    def renderizar(self, url):
+        """Genera el WSDL con `url` como dirección del servicio (sin cachearlo)."""
+        wsdl11 = self.wsgi_app.doc.wsdl11
+        with self._lock:
+            wsdl11.build_interface_document(url)
+            return wsdl11.get_interface_document()
+
+    def precalcular(self, url=None):
+        """Carga el WSDL del archivo o, si no existe y se da `url`, lo genera."""
+        if self.contenido is not None:
+            return True
+        if self.archivo and os.path.exists(self.archivo):
+            with open(self.archivo, 'rb') as f:
+                self._fijar(f.read())
+            logging.info(f"WSDL cargado de {self.archivo}")
+            return True
+        if url:
+            self._fijar(self.renderizar(url))
+            return True
+        return False
 
-# Creamos la aplicación Spyne (que conoce a EncuestaService)
-application = Application([EncuestaService],
-    tns='encuestas.soap.retofinal',
-    in_protocol=Soap11(validator='lxml'),
-    out_protocol=Soap11()
-)
+    def __call__(self, environ, start_response):
+        if not self.wsgi_app.is_wsdl_request(environ):
+            return self.wsgi_app(environ, start_response)
+        if self.contenido is None:
+            # Misma URL que usaría Spyne: la de la petición sin ?wsdl ni .wsdl
+            self.precalcular(request_uri(environ, include_query=False).split('.wsdl')[0])
+        cabeceras = [('ETag', self.etag), ('Cache-Control', 'no-cache')]
+        candidatos = environ.get('HTTP_IF_NONE_MATCH', '')
+        if candidatos.strip() == '*' or self.etag in (c.strip().removeprefix('W/') for c in candidatos.split(',')):
+            start_response('304 Not Modified', cabeceras)
+            return []
+        start_response('200 OK', [('Content-Type', 'text/xml; charset=utf-8'),
+                                  ('Content-Length', str(len(self.contenido)))] + cabeceras)
+        return [self.contenido]
+
+
+documento_wsdl = WSDLPrecalculado(WSDL_ARCHIVO)
+
+
+class DespachadorWSGI:
+    """Envía cada petición a la aplicación montada en su ruta; el resto va a
+    la aplicación por defecto (SOAP)."""
+
+    def __init__(self, por_defecto, rutas=None):
+        self.por_defecto = por_defecto
+        self.rutas = dict(rutas or {})
+
+    def montar(self, ruta, app):
+        self.rutas[ruta.rstrip('/')] = app
+
+    def __call__(self, environ, start_response):
+        ruta = environ.get('PATH_INFO') or '/'
+        for prefijo, app in self.rutas.items():
+            if ruta == prefijo or ruta.startswith(prefijo + '/'):
+                return app(environ, start_response)
+        return self.por_defecto(environ, start_response)
+
+
+_aplicacion_lock = threading.Lock()
+# Nombres del módulo que se definen al construir la aplicación (ver __getattr__)
+_NOMBRES_APLICACION = ('application', 'wsgi_application', 'json_application', 'wsgi_json',
+                       'msgpack_application', 'wsgi_msgpack', 'aplicacion_wsgi')
+
+
+def crear_aplicacion(esquema=None):
+    """Construye una sola vez las aplicaciones Spyne y el despachador WSGI y
+    devuelve este último: SOAP en /, JSON en /json (y MessagePack en /msgpack
+    si está disponible), métricas en /metrics y descarga de respuestas en
+    /exportar/respuestas.
+
+    Solo abre una conexión a la BD si hay que crear el esquema: `esquema`
+    (por defecto ESQUEMA_AUTOCREAR) lo crea al construir la aplicación, es
+    decir, una vez por proceso, también cuando la monta otro servidor WSGI.
+    """
+    modulo = globals()
+    if 'aplicacion_wsgi' in modulo:
+        return modulo['aplicacion_wsgi']
+    with _aplicacion_lock:
+        if 'aplicacion_wsgi' in modulo:
+            return modulo['aplicacion_wsgi']
+
+        if ESQUEMA_AUTOCREAR if esquema is None else esquema:
+            crear_esquema()
+
+        # Aplicación Spyne (que conoce a EncuestaService)
+        application = Application([EncuestaService],
+            tns='encuestas.soap.retofinal',
+            in_protocol=Soap11(validator='lxml'),
+            out_protocol=Soap11()
+        )
+
+        # Envolvemos la aplicación Spyne en un estándar WSGI
+        wsgi_application = WsgiApplication(application)
+        documento_wsdl.wsgi_app = wsgi_application
+
+        # Protocolos ligeros para clientes internos (móvil, procesos por lotes): el
+        # mismo EncuestaService sin sobre SOAP ni validación de esquema con lxml.
+        # Petición: {"crear_encuesta": {"encuesta": {"titulo": "..."}}}; la respuesta
+        # es directamente el valor devuelto (sin envoltorios).
+        json_application = Application([EncuestaService],
+            tns='encuestas.soap.retofinal',
+            name='EncuestaServiceJson',
+            in_protocol=JsonDocument(validator='soft'),
+            out_protocol=JsonDocument()
+        )
+        wsgi_json = WsgiApplication(json_application)
+
+        # MessagePack solo si el paquete `msgpack` está instalado
+        try:
+            from spyne.protocol.msgpack import MessagePackDocument
+        except ImportError:
+            msgpack_application = wsgi_msgpack = None
+        else:
+            msgpack_application = Application([EncuestaService],
+                tns='encuestas.soap.retofinal',
+                name='EncuestaServiceMsgPack',
+                in_protocol=MessagePackDocument(validator='soft'),
+                out_protocol=MessagePackDocument()
+            )
+            wsgi_msgpack = WsgiApplication(msgpack_application)
+
+        aplicacion_wsgi = DespachadorWSGI(con_metricas(documento_wsdl), {'/metrics': metricas_wsgi,
+                                                                         '/exportar/respuestas': exportar_wsgi})
+        aplicacion_wsgi.montar('/json', con_metricas(wsgi_json, 'json'))
+        if wsgi_msgpack is not None:
+            aplicacion_wsgi.montar('/msgpack', con_metricas(wsgi_msgpack, 'msgpack'))
+
+        # `aplicacion_wsgi` se publica la última: marca la construcción como terminada
+        local = locals()
+        for nombre in _NOMBRES_APLICACION:
+            modulo[nombre] = local[nombre]
+        return aplicacion_wsgi
+
+
+def __getattr__(nombre):
+    # Compatibilidad: `app.engine`, `app.cache_entidades`, `app.application`, `app.aplicacion_wsgi`...
+    # siguen disponibles, pero se crean en el primer acceso.
+    if nombre == 'engine':
+        return obtener_engine()
+    if nombre == 'cache_entidades':
+        return obtener_cache()
+    if nombre in _NOMBRES_APLICACION:
+        crear_aplicacion()
+        return globals()[nombre]
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
+
+# Modo de servicio: un pool de hilos por proceso y, opcionalmente, varios
+# procesos trabajadores que comparten el socket de escucha.
+SERVIDOR_HOST = os.getenv('SERVIDOR_HOST', '0.0.0.0')
+SERVIDOR_PUERTO = int(os.getenv('SERVIDOR_PUERTO', '8000'))
+SERVIDOR_HILOS = int(os.getenv('SERVIDOR_HILOS', '8'))
+SERVIDOR_PROCESOS = int(os.getenv('SERVIDOR_PROCESOS', '1'))
+
+
+class ServidorWSGIConHilos(WSGIServer):
+    """WSGIServer que atiende cada conexión en un pool acotado de hilos."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, direccion, handler, hilos=SERVIDOR_HILOS):
+        self.hilos = max(1, hilos)
+        self._pool = None
+        super().__init__(direccion, handler)
+
+    def process_request(self, request, client_address):
+        # El pool se crea perezosamente para que cada proceso hijo tenga el suyo
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.hilos, thread_name_prefix='soap')
+        self._pool.submit(self._atender, request, client_address)
+
+    def _atender(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if self._pool is not None:
+            # Esperar a que terminen las peticiones en curso
+            self._pool.shutdown(wait=True)
+
+
+def _servir_proceso(server):
+    """Bucle de un proceso: atiende hasta recibir SIGTERM/SIGINT y cierra limpio."""
+    def detener(signum, frame):
+        logging.info(f"Proceso {os.getpid()}: señal {signum} recibida, deteniendo servidor")
+        # shutdown() bloquea hasta que serve_forever termina: llamarlo desde otro hilo
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, detener)
+    signal.signal(signal.SIGINT, detener)
+    if spool_respuestas is not None:
+        # Vaciar también lo que quedó pendiente de una ejecución anterior
+        spool_respuestas.iniciar()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if spool_respuestas is not None:
+            spool_respuestas.detener()
+        _liberar_engine()
+
+
+def servir(host=SERVIDOR_HOST, puerto=SERVIDOR_PUERTO, hilos=SERVIDOR_HILOS, procesos=SERVIDOR_PROCESOS,
+           esquema=ESQUEMA_AUTOCREAR):
+    if procesos > 1 and not hasattr(os, 'fork'):
+        logging.warning("Esta plataforma no soporta fork: se usará un solo proceso")
+        procesos = 1
+
+    if esquema:
+        crear_esquema()
+    # Construir la aplicación y cargar el WSDL pregenerado antes del fork: los
+    # procesos hijos los heredan ya listos. El esquema ya se trató arriba
+    # (`--crear-esquema` / `--no-crear-esquema` manda sobre ESQUEMA_AUTOCREAR).
+    aplicacion = crear_aplicacion(esquema=False)
+    documento_wsdl.precalcular()
+    server = make_server(host, puerto, aplicacion,
+                         server_class=lambda direccion, handler: ServidorWSGIConHilos(direccion, handler, hilos))
+    logging.info(f"Servidor SOAP iniciado en http://localhost:{puerto}/ ({procesos} proceso(s) x {hilos} hilo(s))")
+    logging.info(f"WSDL disponible en: http://localhost:{puerto}/?wsdl")
+    logging.info(f"Métricas disponibles en: http://localhost:{puerto}/metrics")
+
+    if procesos <= 1:
+        _servir_proceso(server)
+        return
+
+    # No heredar conexiones abiertas del padre: cada hijo crea su propio engine
+    _liberar_engine()
+    hijos = []
+    for _ in range(procesos):
+        pid = os.fork()
+        if pid == 0:
+            codigo = 0
+            try:
+                reiniciar_engine()
+                _servir_proceso(server)
+            except Exception:
+                logging.exception("Error en proceso trabajador")
+                codigo = 1
+            finally:
+                os._exit(codigo)
+        hijos.append(pid)
+
+    def reenviar(signum, frame):
+        for pid in hijos:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, reenviar)
+    signal.signal(signal.SIGINT, reenviar)
+    for pid in hijos:
+        os.waitpid(pid, 0)
+    server.server_close()
+    logging.info("Servidor detenido")
 
-# Envolvemos la aplicación Spyne en un estándar WSGI
-wsgi_application = WsgiApplication(application)
 
 if __name__ == '__main__':
-    from wsgiref.simple_server import make_server
-    
-    server = make_server('0.0.0.0', 8000, wsgi_application)
-    logging.info("Servidor SOAP iniciado en http://localhost:8000/")
-    logging.info("WSDL disponible en: http://localhost:8000/?wsdl")
-    server.serve_forever()
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Servicio SOAP de encuestas')
+    subcomandos = parser.add_subparsers(dest='comando')
+    p_servir = subcomandos.add_parser('servir', help='Inicia el servidor SOAP (por defecto)')
+    p_servir.add_argument('--host', default=SERVIDOR_HOST)
+    p_servir.add_argument('--puerto', type=int, default=SERVIDOR_PUERTO)
+    p_servir.add_argument('--hilos', type=int, default=SERVIDOR_HILOS, help='Hilos por proceso')
+    p_servir.add_argument('--procesos', type=int, default=SERVIDOR_PROCESOS, help='Procesos trabajadores')
+    p_servir.add_argument('--crear-esquema', action=argparse.BooleanOptionalAction, default=ESQUEMA_AUTOCREAR,
+                          dest='esquema', help='Crear las tablas que falten antes de servir')
+    subcomandos.add_parser('crear-esquema', help='Crea las tablas, índices e índice de búsqueda que falten')
+    p_wsdl = subcomandos.add_parser('generar-wsdl', help='Genera el WSDL una vez para servirlo ya renderizado')
+    p_wsdl.add_argument('--url', default=f'http://localhost:{SERVIDOR_PUERTO}/',
+                        help='Dirección pública del servicio que figurará en el WSDL')
+    p_wsdl.add_argument('--salida', default=WSDL_ARCHIVO, help='Archivo de salida (WSDL_ARCHIVO)')
+    subcomandos.add_parser('reconstruir-resultados', help='Recalcula los conteos agregados de respuestas')
+    subcomandos.add_parser('aplicar-indices', help='Crea en las tablas existentes los índices que falten')
+    subcomandos.add_parser('verificar-planes',
+                           help='Comprueba con EXPLAIN (SQLite) que las consultas críticas usan índices')
+    subcomandos.add_parser('reindexar-busqueda', help='Reconstruye el índice de búsqueda de texto')
+    p_depurar = subcomandos.add_parser('depurar-cambios', help='Borra del registro de cambios las filas antiguas')
+    p_depurar.add_argument('--dias', type=int, default=CAMBIOS_RETENCION_DIAS, help='Días de cambios que se conservan')
+    subcomandos.add_parser('vaciar-spool', help='Vuelca a la BD las respuestas diferidas pendientes del spool')
+    p_exportar = subcomandos.add_parser('exportar', help='Exporta las respuestas en CSV o NDJSON')
+    p_exportar.add_argument('--formato', choices=['csv', 'ndjson'], default='csv')
+    p_exportar.add_argument('--id-encuesta', type=int, dest='id_encuesta')
+    p_exportar.add_argument('--desde', type=datetime.fromisoformat, help='Fecha inicial (inclusiva), ISO 8601')
+    p_exportar.add_argument('--hasta', type=datetime.fromisoformat, help='Fecha final (exclusiva), ISO 8601')
+    p_exportar.add_argument('--gzip', action='store_true', help='Comprimir la salida con gzip')
+    p_exportar.add_argument('--salida', help='Archivo de salida (por defecto, la salida estándar)')
+    args = parser.parse_args()
+
+    if args.comando == 'crear-esquema':
+        if not crear_esquema():
+            sys.exit(1)
+        logging.info("Esquema creado")
+    elif args.comando == 'generar-wsdl':
+        crear_aplicacion()
+        contenido = documento_wsdl.renderizar(args.url)
+        with open(args.salida, 'wb') as f:
+            f.write(contenido)
+        logging.info(f"WSDL escrito en {args.salida} ({len(contenido)} bytes)")
+    elif args.comando == 'reconstruir-resultados':
+        db = SessionLocal()
+        try:
+            reconstruir_resultados(db)
+        finally:
+            db.close()
+        logging.info("Conteos de resultados reconstruidos")
+    elif args.comando == 'aplicar-indices':
+        creados = aplicar_indices(obtener_engine())
+        logging.info(f"Índices creados: {', '.join(creados)}" if creados else "No faltaba ningún índice")
+    elif args.comando == 'verificar-planes':
+        if obtener_engine().dialect.name != 'sqlite':
+            logging.error("verificar-planes usa EXPLAIN QUERY PLAN y solo funciona con SQLite")
+            sys.exit(2)
+        if obtener_engine().url.database in (None, '', ':memory:'):
+            # Base en memoria (CI): empieza vacía, hay que crear el esquema
+            crear_esquema()
+        fallos = 0
+        for nombre, plan, problemas in verificar_planes(obtener_engine()):
+            fallos += 1 if problemas else 0
+            print(f"{'FALLA' if problemas else 'OK':<7}{nombre}" + (f" ({'; '.join(problemas)})" if problemas else ''))
+            for linea in plan:
+                print(f"{'':<7}  {linea}")
+        if fallos:
+            print(f"\n{fallos} consultas sin los índices esperados (¿falta `python3 app.py aplicar-indices`?)")
+            sys.exit(1)
+    elif args.comando == 'reindexar-busqueda':
+        db = SessionLocal()
+        try:
+            indice_busqueda.reindexar(db)
+        finally:
+            db.close()
+        logging.info(f"Índice de búsqueda reconstruido ({indice_busqueda.nombre})")
+    elif args.comando == 'depurar-cambios':
+        db = SessionLocal()
+        try:
+            borrados = depurar_cambios(db, args.dias)
+        finally:
+            db.close()
+        logging.info(f"Registro de cambios depurado: {borrados} filas borradas")
+    elif args.comando == 'vaciar-spool':
+        spool = spool_respuestas or SpoolRespuestas()
+        while spool.vaciar_lote():
+            pass
+        spool.depurar()
+        logging.info(f"Spool vaciado: {spool.persistidas} persistidas, {spool.rechazadas} rechazadas, "
+                     f"{spool.pendientes(releer=True)} pendientes")
+    elif args.comando == 'exportar':
+        destino = open(args.salida, 'wb') if args.salida else sys.stdout.buffer
+        try:
+            for bloque in exportar_respuestas(args.formato, args.id_encuesta, args.desde, args.hasta, args.gzip):
+                destino.write(bloque)
+        finally:
+            if args.salida:
+                destino.close()
+    elif args.comando == 'servir':
+        servir(args.host, args.puerto, args.hilos, args.procesos, args.esquema)
+    else:
+        servir()
@@ -0,0 +1,541 @@
+"""Benchmark reproducible del servicio SOAP de encuestas.
+
+Ejecuta cargas contra `app.aplicacion_wsgi` en el mismo proceso y/o por HTTP
+local, con cada protocolo (SOAP en /, JSON en /json, MessagePack en /msgpack),
+usando siempre una base de datos SQLite temporal. Mide throughput y latencias
+p50/p95/p99 por operación y guarda los resultados en JSON para comparar
+ejecuciones:
+
+    python3 benchmark.py --salida base.json
+    python3 benchmark.py --comparar base.json     # sale con código 1 si hay regresiones
+
+Escenarios:
+- crud:   crear/obtener/actualizar/listar/eliminar de cada entidad.
+- envio:  flujo mixto de envío de encuestas (crear usuario, leer la encuesta y
+          sus preguntas, responder una a una o por lote, consultar resultados).
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+NS = 'encuestas.soap.retofinal'
+
+
+def sobre(operacion: str, cuerpo: str = '') -> bytes:
+    """Construye el sobre SOAP 1.1 de una operación."""
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:tns="{NS}">'
+            f'<soapenv:Body><tns:{operacion}>{cuerpo}</tns:{operacion}></soapenv:Body>'
+            f'</soapenv:Envelope>').encode('utf-8')
+
+
+def _xml(valor) -> str:
+    """Parámetros -> XML. Los arreglos son tuplas (nombre del elemento, lista)."""
+    if isinstance(valor, dict):
+        return ''.join(f'<tns:{k}>{_xml(v)}</tns:{k}>' for k, v in valor.items() if v is not None)
+    if isinstance(valor, tuple):
+        nombre, elementos = valor
+        return ''.join(f'<tns:{nombre}>{_xml(e)}</tns:{nombre}>' for e in elementos)
+    return str(valor)
+
+
+def _documento(valor):
+    """Parámetros -> estructura para JSON/MessagePack (sin nulos, arreglos como listas)."""
+    if isinstance(valor, dict):
+        return {k: _documento(v) for k, v in valor.items() if v is not None}
+    if isinstance(valor, tuple):
+        return [_documento(e) for e in valor[1]]
+    return valor
+
+
+# --- Protocolos ---
+
+class ProtocoloSoap:
+    nombre = 'soap'
+    ruta = '/'
+    tipo = 'text/xml; charset=utf-8'
+
+    def codificar(self, operacion, parametros) -> bytes:
+        return sobre(operacion, _xml(parametros))
+
+    def extraer_id(self, cuerpo: bytes, campo: str):
+        m = re.search(rf'<(?:\w+:)?{campo}>(-?\d+)<'.encode(), cuerpo)
+        return int(m.group(1)) if m else None
+
+
+class ProtocoloJson:
+    """JsonDocument de Spyne: {"operacion": {parámetros}} y respuesta sin envoltorios."""
+
+    nombre = 'json'
+    ruta = '/json'
+    tipo = 'application/json'
+
+    def codificar(self, operacion, parametros) -> bytes:
+        return json.dumps({operacion: _documento(parametros)}).encode('utf-8')
+
+    def decodificar(self, cuerpo: bytes):
+        return json.loads(cuerpo)
+
+    def extraer_id(self, cuerpo: bytes, campo: str):
+        try:
+            documento = self.decodificar(cuerpo)
+        except ValueError:
+            return None
+        return documento.get(campo) if isinstance(documento, dict) else None
+
+
+class ProtocoloMsgPack(ProtocoloJson):
+    nombre = 'msgpack'
+    ruta = '/msgpack'
+    tipo = 'application/x-msgpack'
+
+    def codificar(self, operacion, parametros) -> bytes:
+        import msgpack
+        return msgpack.packb({operacion: _documento(parametros)})
+
+    def decodificar(self, cuerpo: bytes):
+        import msgpack
+        return msgpack.unpackb(cuerpo, raw=False)
+
+
+PROTOCOLOS = {p.nombre: p for p in (ProtocoloSoap(), ProtocoloJson(), ProtocoloMsgPack())}
+
+
+def _protocolos_disponibles():
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        return ['soap', 'json']
+    return ['soap', 'json', 'msgpack']
+
+
+# --- Peticiones por operación: (operación, parámetros) ---
+
+def crear_encuesta(i):
+    return 'crear_encuesta', {'encuesta': {'titulo': f"Encuesta {i}", 'descripcion': "Benchmark"}}
+
+
+def obtener_encuesta(id_encuesta):
+    return 'obtener_encuesta', {'id_encuesta': id_encuesta}
+
+
+def actualizar_encuesta(id_encuesta):
+    return 'actualizar_encuesta', {'encuesta_actualizada': {'id_encuesta': id_encuesta, 'titulo': "Actualizada",
+                                                            'descripcion': "Benchmark"}}
+
+
+def eliminar_encuesta(id_encuesta):
+    return 'eliminar_encuesta', {'id_encuesta': id_encuesta}
+
+
+def listar_encuestas(despues_de=None, limite=50):
+    return 'listar_encuestas', {'despues_de': despues_de, 'limite': limite}
+
+
+def crear_pregunta(id_encuesta, i):
+    return 'crear_pregunta', {'pregunta': {'id_encuesta': id_encuesta, 'texto_pregunta': f"Pregunta {i}"}}
+
+
+def obtener_pregunta(id_pregunta):
+    return 'obtener_pregunta', {'id_pregunta': id_pregunta}
+
+
+def actualizar_pregunta(id_pregunta, id_encuesta):
+    return 'actualizar_pregunta', {'pregunta_actualizada': {'id_pregunta': id_pregunta, 'id_encuesta': id_encuesta,
+                                                            'texto_pregunta': "Actualizada"}}
+
+
+def eliminar_pregunta(id_pregunta):
+    return 'eliminar_pregunta', {'id_pregunta': id_pregunta}
+
+
+def listar_preguntas_por_encuesta(id_encuesta):
+    return 'listar_preguntas_por_encuesta', {'id_encuesta': id_encuesta, 'limite': 100}
+
+
+def crear_usuario(i):
+    return 'crear_usuario', {'usuario': {'nombre': f"Usuario {i}", 'apellidos': "Benchmark", 'email': f"u{i}@example.com",
+                                         'telefono': "5550000", 'genero': "X"}}
+
+
+def obtener_usuario(id_usuario):
+    return 'obtener_usuario', {'id_usuario': id_usuario}
+
+
+def actualizar_usuario(id_usuario):
+    return 'actualizar_usuario', {'usuario_actualizado': {'id_usuario': id_usuario, 'nombre': "Actualizado",
+                                                          'email': "a@example.com"}}
+
+
+def eliminar_usuario(id_usuario):
+    return 'eliminar_usuario', {'id_usuario': id_usuario}
+
+
+def crear_respuesta(id_pregunta, id_usuario, texto):
+    return 'crear_respuesta', {'respuesta': {'id_pregunta': id_pregunta, 'id_usuario': id_usuario, 'texto_respuesta': texto}}
+
+
+def crear_respuestas_lote(respuestas):
+    elementos = [{'id_pregunta': p, 'id_usuario': u, 'texto_respuesta': t} for p, u, t in respuestas]
+    return 'crear_respuestas_lote', {'respuestas': ('Respuesta', elementos)}
+
+
+def obtener_respuesta(id_respuesta):
+    return 'obtener_respuesta', {'id_respuesta': id_respuesta}
+
+
+def obtener_respuesta_diferida(id_provisional):
+    return 'obtener_respuesta_diferida', {'id_provisional': id_provisional}
+
+
+def actualizar_respuesta(id_respuesta, id_usuario):
+    return 'actualizar_respuesta', {'respuesta_actualizada': {'id_respuesta': id_respuesta, 'id_usuario': id_usuario,
+                                                              'texto_respuesta': "Cambiada"}}
+
+
+def eliminar_respuesta(id_respuesta):
+    return 'eliminar_respuesta', {'id_respuesta': id_respuesta}
+
+
+def obtener_resultados_encuesta(id_encuesta):
+    return 'obtener_resultados_encuesta', {'id_encuesta': id_encuesta}
+
+
+OPCIONES = ('Muy de acuerdo', 'De acuerdo', 'Neutral', 'En desacuerdo', 'Muy en desacuerdo')
+
+
+# --- Clientes ---
+
+class ClienteEnProceso:
+    """Llama a la aplicación WSGI directamente, sin red."""
+
+    nombre = 'proceso'
+
+    def __init__(self, app_wsgi, protocolo):
+        self.app_wsgi = app_wsgi
+        self.protocolo = protocolo
+
+    def llamar(self, datos: bytes):
+        environ = {
+            'REQUEST_METHOD': 'POST', 'PATH_INFO': self.protocolo.ruta, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+            'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_TYPE': self.protocolo.tipo, 'CONTENT_LENGTH': str(len(datos)),
+            'wsgi.input': io.BytesIO(datos), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0), 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        estado = []
+        respuesta = self.app_wsgi(environ, lambda status, headers, exc_info=None: estado.append(status))
+        try:
+            cuerpo = b''.join(respuesta)
+        finally:
+            if hasattr(respuesta, 'close'):
+                respuesta.close()
+        return int(estado[0].split()[0]), cuerpo
+
+
+class ClienteHTTP:
+    """Llama al servicio por HTTP local (una conexión por petición, como wsgiref/HTTP 1.0)."""
+
+    nombre = 'http'
+
+    def __init__(self, puerto, protocolo):
+        self.puerto = puerto
+        self.protocolo = protocolo
+
+    def llamar(self, datos: bytes):
+        conn = http.client.HTTPConnection('127.0.0.1', self.puerto, timeout=60)
+        try:
+            conn.request('POST', self.protocolo.ruta, body=datos, headers={'Content-Type': self.protocolo.tipo})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        finally:
+            conn.close()
+
+
+class Medidor:
+    """Registra latencias por operación y errores."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}
+        self.errores = {}
+
+    def medir(self, cliente, peticion):
+        operacion, parametros = peticion
+        inicio = time.perf_counter()
+        estado, cuerpo = cliente.llamar(cliente.protocolo.codificar(operacion, parametros))
+        duracion = time.perf_counter() - inicio
+        with self._lock:
+            self.latencias.setdefault(operacion, []).append(duracion)
+            if estado >= 400:
+                self.errores[operacion] = self.errores.get(operacion, 0) + 1
+        return cuerpo
+
+
+def _id(cliente, cuerpo: bytes, campo: str):
+    return cliente.protocolo.extraer_id(cuerpo, campo)
+
+
+def _id_definitivo(cliente, medir, id_respuesta, plazo=30.0):
+    """Con RESPUESTAS_DIFERIDAS, crear_respuesta devuelve un id provisional
+    (negativo): espera a que el spool guarde la respuesta y devuelve su id."""
+    limite = time.monotonic() + plazo
+    while id_respuesta is not None and id_respuesta < 0:
+        if time.monotonic() > limite:
+            raise RuntimeError(f'La respuesta diferida {id_respuesta} no se guardó en {plazo:.0f} s')
+        definitivo = _id(cliente, medir(cliente, obtener_respuesta_diferida(id_respuesta)), 'id_respuesta')
+        if definitivo:
+            return definitivo
+        time.sleep(0.01)
+    return id_respuesta
+
+
+def _percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    k = (len(ordenados) - 1) * p / 100.0
+    inferior = int(k)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (k - inferior)
+
+
+def _resumen(medidor, segundos):
+    resumen = {}
+    for operacion, latencias in sorted(medidor.latencias.items()):
+        resumen[operacion] = {
+            'peticiones': len(latencias),
+            'errores': medidor.errores.get(operacion, 0),
+            'rps': len(latencias) / segundos if segundos else 0.0,
+            'media_ms': statistics.fmean(latencias) * 1000,
+            'p50_ms': _percentil(latencias, 50) * 1000,
+            'p95_ms': _percentil(latencias, 95) * 1000,
+            'p99_ms': _percentil(latencias, 99) * 1000,
+        }
+    total = sum(len(l) for l in medidor.latencias.values())
+    todas = [x for l in medidor.latencias.values() for x in l]
+    resumen['_total'] = {
+        'peticiones': total,
+        'errores': sum(medidor.errores.values()),
+        'rps': total / segundos if segundos else 0.0,
+        'media_ms': statistics.fmean(todas) * 1000 if todas else 0.0,
+        'p50_ms': _percentil(todas, 50) * 1000,
+        'p95_ms': _percentil(todas, 95) * 1000,
+        'p99_ms': _percentil(todas, 99) * 1000,
+        'segundos': segundos,
+    }
+    return resumen
+
+
+# --- Escenarios ---
+
+def escenario_crud(cliente, args):
+    """Cada cliente crea, lee, actualiza, lista y elimina sus propias entidades."""
+    medidor = Medidor()
+
+    def trabajo(n):
+        m = medidor.medir
+        id_enc = _id(cliente, m(cliente, crear_encuesta(n)), 'id_encuesta')
+        id_usr = _id(cliente, m(cliente, crear_usuario(n)), 'id_usuario')
+        for _ in range(args.repeticiones):
+            m(cliente, obtener_encuesta(id_enc))
+            m(cliente, actualizar_encuesta(id_enc))
+            m(cliente, obtener_usuario(id_usr))
+            m(cliente, actualizar_usuario(id_usr))
+            id_preg = _id(cliente, m(cliente, crear_pregunta(id_enc, n)), 'id_pregunta')
+            m(cliente, obtener_pregunta(id_preg))
+            m(cliente, actualizar_pregunta(id_preg, id_enc))
+            m(cliente, listar_preguntas_por_encuesta(id_enc))
+            id_res = _id(cliente, m(cliente, crear_respuesta(id_preg, id_usr, OPCIONES[n % len(OPCIONES)])), 'id_respuesta')
+            id_res = _id_definitivo(cliente, m, id_res)
+            m(cliente, obtener_respuesta(id_res))
+            m(cliente, actualizar_respuesta(id_res, id_usr))
+            m(cliente, eliminar_respuesta(id_res))
+            m(cliente, eliminar_pregunta(id_preg))
+            m(cliente, listar_encuestas())
+        m(cliente, eliminar_usuario(id_usr))
+        m(cliente, eliminar_encuesta(id_enc))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clientes) as ejecutor:
+        list(ejecutor.map(trabajo, range(args.clientes * args.repeticiones_clientes)))
+    return _resumen(medidor, time.perf_counter() - inicio)
+
+
+def preparar_encuestas(cliente, args):
+    """Crea las encuestas y preguntas sobre las que se responde en `envio`."""
+    medidor = Medidor()
+    encuestas = []
+    for i in range(args.encuestas):
+        id_enc = _id(cliente, medidor.medir(cliente, crear_encuesta(i)), 'id_encuesta')
+        preguntas = [_id(cliente, medidor.medir(cliente, crear_pregunta(id_enc, j)), 'id_pregunta')
+                     for j in range(args.preguntas)]
+        encuestas.append((id_enc, preguntas))
+    return encuestas
+
+
+def escenario_envio(cliente, args, encuestas):
+    """Flujo de un encuestado: se registra, lee la encuesta, responde todas las
+    preguntas (una a una o por lote según --lote) y consulta resultados."""
+    medidor = Medidor()
+
+    def trabajo(n):
+        m = medidor.medir
+        id_enc, preguntas = encuestas[n % len(encuestas)]
+        id_usr = _id(cliente, m(cliente, crear_usuario(n)), 'id_usuario')
+        m(cliente, obtener_encuesta(id_enc))
+        m(cliente, listar_preguntas_por_encuesta(id_enc))
+        respuestas = [(p, id_usr, OPCIONES[(n + k) % len(OPCIONES)]) for k, p in enumerate(preguntas)]
+        if args.lote:
+            m(cliente, crear_respuestas_lote(respuestas))
+        else:
+            for p, u, t in respuestas:
+                m(cliente, crear_respuesta(p, u, t))
+        m(cliente, obtener_resultados_encuesta(id_enc))
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clientes) as ejecutor:
+        list(ejecutor.map(trabajo, range(args.encuestados)))
+    return _resumen(medidor, time.perf_counter() - inicio)
+
+
+# --- Ejecución ---
+
+def _iniciar_http(app):
+    servidor = app.make_server('127.0.0.1', 0, app.aplicacion_wsgi,
+                               server_class=lambda direccion, handler: app.ServidorWSGIConHilos(direccion, handler, 32))
+    # Silenciar el log por petición de wsgiref
+    servidor.RequestHandlerClass.log_message = lambda *a, **k: None
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    return servidor
+
+
+def ejecutar(args):
+    import app
+
+    # La BD temporal está vacía: importar app ya no crea las tablas
+    app.crear_esquema()
+    resultados = {}
+    modos = ['proceso', 'http'] if args.modo == 'ambos' else [args.modo]
+    protocolos = _protocolos_disponibles() if args.protocolo == 'todos' else [args.protocolo]
+    servidor = _iniciar_http(app) if 'http' in modos else None
+    try:
+        for modo in modos:
+            for nombre in protocolos:
+                protocolo = PROTOCOLOS[nombre]
+                if modo == 'proceso':
+                    cliente = ClienteEnProceso(app.aplicacion_wsgi, protocolo)
+                else:
+                    cliente = ClienteHTTP(servidor.server_address[1], protocolo)
+                encuestas = preparar_encuestas(cliente, args)
+                resultados[f'{modo}/{nombre}/crud'] = escenario_crud(cliente, args)
+                resultados[f'{modo}/{nombre}/envio'] = escenario_envio(cliente, args, encuestas)
+    finally:
+        if servidor is not None:
+            servidor.shutdown()
+            servidor.server_close()
+        # Soltar los archivos del directorio temporal antes de borrarlo
+        if app.spool_respuestas is not None:
+            app.spool_respuestas.detener()
+        app._liberar_engine()
+    return resultados
+
+
+def imprimir(resultados):
+    for escenario, operaciones in resultados.items():
+        total = operaciones['_total']
+        print(f"\n== {escenario}: {total['peticiones']} peticiones en {total['segundos']:.2f} s "
+              f"({total['rps']:.1f} pet/s, {total['errores']} errores)")
+        print(f"{'operacion':<32}{'n':>7}{'pet/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'err':>6}")
+        for operacion, datos in operaciones.items():
+            print(f"{operacion:<32}{datos['peticiones']:>7}{datos['rps']:>10.1f}{datos['p50_ms']:>10.2f}"
+                  f"{datos['p95_ms']:>10.2f}{datos['p99_ms']:>10.2f}{datos['errores']:>6}")
+
+
+def comparar(actual, base, tolerancia):
+    """Compara contra una ejecución anterior; devuelve la lista de regresiones."""
+    regresiones = []
+    for escenario, operaciones in actual.items():
+        for operacion, datos in operaciones.items():
+            anterior = base.get(escenario, {}).get(operacion)
+            if not anterior:
+                continue
+            if anterior['p95_ms'] and datos['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia):
+                regresiones.append(f"{escenario} {operacion}: p95 {anterior['p95_ms']:.2f} -> {datos['p95_ms']:.2f} ms")
+            if operacion == '_total' and datos['rps'] < anterior['rps'] * (1 - tolerancia):
+                regresiones.append(f"{escenario}: throughput {anterior['rps']:.1f} -> {datos['rps']:.1f} pet/s")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del servicio SOAP de encuestas')
+    parser.add_argument('--modo', choices=['proceso', 'http', 'ambos'], default='ambos')
+    parser.add_argument('--protocolo', choices=['soap', 'json', 'msgpack', 'todos'], default='todos',
+                        help='Protocolo de las peticiones; todos = soap, json y msgpack si está instalado')
+    parser.add_argument('--encuestas', type=int, default=5, help='Encuestas creadas para el escenario envio')
+    parser.add_argument('--preguntas', type=int, default=10, help='Preguntas por encuesta')
+    parser.add_argument('--encuestados', type=int, default=100, help='Personas que responden en el escenario envio')
+    parser.add_argument('--clientes', type=int, default=8, help='Clientes concurrentes')
+    parser.add_argument('--repeticiones', type=int, default=3, help='Ciclos CRUD por cliente')
+    parser.add_argument('--repeticiones-clientes', type=int, default=1, dest='repeticiones_clientes',
+                        help='Tareas CRUD por cliente concurrente')
+    parser.add_argument('--lote', action='store_true', help='Enviar las respuestas con crear_respuestas_lote')
+    parser.add_argument('--salida', help='Archivo JSON donde guardar los resultados')
+    parser.add_argument('--comparar', help='Archivo JSON de una ejecución anterior para detectar regresiones')
+    parser.add_argument('--tolerancia', type=float, default=0.15, help='Empeoramiento relativo permitido (0.15 = 15%%)')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    # Base de datos, caché y spool temporales: el benchmark nunca toca la BD
+    # configurada ni deja archivos al terminar
+    with tempfile.TemporaryDirectory(prefix='bench_encuestas_', ignore_cleanup_errors=True) as directorio:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directorio, 'bench.db')}"
+        os.environ['CACHE_SQLITE_PATH'] = os.path.join(directorio, 'cache.db')
+        os.environ['SPOOL_RUTA'] = os.path.join(directorio, 'spool_respuestas.db')
+        resultados = ejecutar(args)
+    imprimir(resultados)
+
+    documento = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': vars(args),
+        'entorno': {k: v for k, v in os.environ.items()
+                    if k.startswith(('SQLITE_', 'CACHE_', 'DB_', 'ESCRITOR_', 'LOTE_', 'LISTADO_', 'SPOOL_',
+                                     'RESPUESTAS_'))},
+        'resultados': resultados,
+    }
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(documento, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)['resultados']
+        regresiones = comparar(resultados, base, args.tolerancia)
+        if regresiones:
+            print('\nREGRESIONES detectadas:')
+            for linea in regresiones:
+                print(f'  - {linea}')
+            sys.exit(1)
+        print('\nSin regresiones respecto a', args.comparar)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Base en memoria: app.py lee DATABASE_URL al importarse
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,23 @@
+"""Regresión de planes de consulta: las consultas críticas del servicio
+(`verificar-planes`) no deben recorrer tablas completas ni perder su índice."""
+import pytest
+
+import app
+
+
+@pytest.fixture(scope='module')
+def engine():
+    assert app.crear_esquema()
+    return app.obtener_engine()
+
+
+def test_consultas_criticas_usan_sus_indices(engine):
+    resultados = app.verificar_planes(engine)
+    assert resultados
+    problemas = {nombre: problemas for nombre, _, problemas in resultados if problemas}
+    assert problemas == {}
+
+
+def test_busqueda_por_tokens_usa_la_clave_primaria(engine):
+    planes = {nombre: plan for nombre, plan, _ in app.verificar_planes(engine)}
+    assert any('USING INDEX sqlite_autoindex_search_tokens_1' in linea for linea in planes['buscar (tokens)'])